@@ -0,0 +1,465 @@
+import os
+import re
+import sys
+import csv
+import io
+import json
+import glob
+import time
+import platform
+import shlex
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import generate_data
+
+# End to end benchmark of the three Sparkify pipelines over generated datasets
+# of several sizes. Every pipeline stage runs in a child process, whose wall
+# time and peak resident memory (summed over its process tree) are recorded
+# and written as JSON so runs can be compared with --compare
+
+PROJECTS_DIR = os.path.dirname(os.path.abspath(__file__))
+POSTGRES_DIR = os.path.join(PROJECTS_DIR, 'data_modeling_with_postgres')
+SPARK_DIR = os.path.join(PROJECTS_DIR, 'data_lake_with_aws_emr')
+REDSHIFT_DIR = os.path.join(PROJECTS_DIR, 'datawarehouse_with_aws_redshift')
+
+PIPELINES = ['postgres', 'spark', 'redshift']
+TABLES = ['songplays', 'users', 'songs', 'artists', 'time']
+REDSHIFT_SCHEMA = 'redshift_standin'
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_tree_rss(root_pid):
+    """returns the resident memory in bytes of root_pid and all its descendants, read from /proc"""
+    children = {}
+    rss = {}
+    for stat_path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        pid = int(stat_path.split('/')[2])
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * PAGE_SIZE
+
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending.extend(children.get(pid, []))
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Samples the resident memory of a process tree until stopped and keeps the peak"""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def run_stage(name, command, cwd, log_path, env=None, metrics_path=None):
+    """
+    Runs command in cwd, appends its output to log_path and returns a stage
+    record with its wall time, peak RSS and return code. The stages and
+    statement totals the command wrote to the JSON metrics log at
+    metrics_path are added to the record
+    """
+    print('{}: {}'.format(name, ' '.join(command)))
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, bufsize=1)
+    sampler = RssSampler(proc.pid)
+    sampler.start()
+
+    with open(log_path, 'a') as log:
+        for line in proc.stdout:
+            log.write(line)
+    returncode = proc.wait()
+    end = time.perf_counter()
+    peak = sampler.stop()
+
+    stage = {'name': name, 'seconds': round(end - start, 3), 'peak_rss_mb': round(peak / 2 ** 20, 1),
+             'returncode': returncode}
+    if metrics_path:
+        stage.update(read_metrics(metrics_path))
+    return stage
+
+
+def read_metrics(path):
+    """
+    Reads the JSON metrics log of a pipeline run and returns its stages,
+    without the per commit batches, and its statement totals, slowest first
+    """
+    stages, statements = [], []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                event = json.loads(line)
+                if event['kind'] == 'stage' and event['name'] != 'batch':
+                    stages.append({key: event[key] for key in ['name', 'seconds', 'rows', 'bytes', 'retries']})
+                elif event['kind'] == 'sql_total':
+                    statements.append({key: event[key] for key in ['name', 'count', 'seconds', 'rows', 'bytes']})
+    return {'stages': stages, 'statements': sorted(statements, key=lambda s: s['seconds'], reverse=True)}
+
+
+def count_rows(dsn, schema=None):
+    """returns the row count of every star schema table in the database, optionally in schema"""
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    if schema:
+        cur.execute('SET search_path TO {}'.format(schema))
+    counts = {}
+    for table in TABLES:
+        cur.execute('SELECT count(*) FROM {}'.format(table))
+        counts[table] = cur.fetchone()[0]
+    conn.close()
+    return counts
+
+
+def run_postgres(data_dir, work_dir, args):
+    """runs create_tables.py and etl.py against the local Postgres and returns the stage records and row counts"""
+    env = dict(os.environ, SPARKIFY_DSN=args.dsn, SPARKIFY_ADMIN_DSN=args.admin_dsn)
+    log_path = os.path.join(work_dir, 'postgres.log')
+    metrics_path = os.path.join(work_dir, 'postgres-metrics.jsonl')
+    command = [sys.executable, 'create_tables.py'] + shlex.split(args.create_tables_args)
+    stages = [run_stage('create_tables', command, POSTGRES_DIR, log_path, env)]
+    if stages[-1]['returncode'] == 0:
+        command = [sys.executable, 'etl.py', '--data-dir', os.path.join(data_dir, 'nested'),
+                   '--metrics-log', metrics_path] + args.postgres_args
+        stages.append(run_stage('etl', command, POSTGRES_DIR, log_path, env, metrics_path))
+    return stages, log_path
+
+
+def run_child(pipeline, data_dir, work_dir, args):
+    """runs the spark or redshift pipeline in a child process of this script and returns its stage records"""
+    log_path = os.path.join(work_dir, pipeline + '.log')
+    metrics_path = os.path.join(work_dir, pipeline + '-metrics.jsonl')
+    rows_path = os.path.join(work_dir, pipeline + '-rows.json')
+    layout = 'flat' if pipeline == 'spark' else 'nested'
+    command = [sys.executable, os.path.abspath(__file__), '--child', pipeline,
+               '--data-dir', os.path.join(data_dir, layout), '--work-dir', work_dir,
+               '--metrics-log', metrics_path, '--rows-file', rows_path]
+    env = dict(os.environ, SPARKIFY_DSN=args.dsn)
+    stage = run_stage(pipeline, command, work_dir, log_path, env, metrics_path)
+    if os.path.exists(rows_path):
+        with open(rows_path) as f:
+            stage['rows'] = json.load(f)
+    return [stage], log_path
+
+
+def run_pipeline(pipeline, size, data_dir, work_dir, summary, args):
+    """runs one pipeline over one dataset and returns its result record"""
+    work_dir = os.path.join(work_dir, pipeline)
+    os.makedirs(work_dir, exist_ok=True)
+    if pipeline == 'postgres':
+        stages, log_path = run_postgres(data_dir, work_dir, args)
+        ok = all(stage['returncode'] == 0 for stage in stages)
+        rows = count_rows(args.dsn) if ok else {}
+    else:
+        stages, log_path = run_child(pipeline, data_dir, work_dir, args)
+        ok = stages[0]['returncode'] == 0
+        rows = stages[0].pop('rows', {})
+
+    seconds = sum(stage['seconds'] for stage in stages)
+    output_rows = sum(rows.values())
+    return {
+        'pipeline': pipeline,
+        'size': size,
+        'status': 'ok' if ok else 'failed',
+        'log': log_path,
+        'wall_seconds': round(seconds, 3),
+        'input_events': summary['log_lines'],
+        'input_songs': summary['songs'],
+        'events_per_second': round(summary['log_lines'] / seconds, 1) if seconds else None,
+        'output_rows': rows,
+        'rows_per_second': round(output_rows / seconds, 1) if seconds else None,
+        'peak_rss_mb': max(stage['peak_rss_mb'] for stage in stages),
+        'stages': stages
+    }
+
+
+def prepare_dataset(data_dir, size, seed):
+    """
+    Generates the dataset of size NextSong events under data_dir in both log
+    layouts, unless an earlier run already did, and returns its summary
+    """
+    summary_path = os.path.join(data_dir, 'summary.json')
+    if os.path.exists(summary_path):
+        with open(summary_path) as f:
+            return json.load(f)
+
+    options = dict(num_songs=max(100, size // 20), num_users=max(50, size // 1000), num_events=size, seed=seed)
+    for layout in ['nested', 'flat']:
+        print('generating {} events in {} layout'.format(size, layout))
+        summary = generate_data.generate(os.path.join(data_dir, layout), layout=layout, **options)
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f)
+    return summary
+
+
+def spark_child(args):
+    """runs the Spark data lake job on the local filesystem with local[*] and returns its row counts"""
+    sys.path.insert(0, SPARK_DIR)
+    from instrumentation import Instrumentation
+    import etl
+
+    input_data = args.data_dir.rstrip('/') + '/'
+    output_data = os.path.join(args.work_dir, 'output') + '/'
+    metrics = Instrumentation('spark', args.metrics_log)
+
+    with metrics.stage('session'):
+        spark = etl.create_spark_session('local[*]', {'spark.app.name': 'sparkify-benchmark'}, s3=False)
+    song_df = etl.read_song_data(spark, input_data, metrics=metrics)
+    with metrics.stage('process_song_data'):
+        etl.process_song_data(spark, input_data, output_data, metrics, song_df)
+    with metrics.stage('process_log_data'):
+        etl.process_log_data(spark, input_data, output_data, metrics, song_df)
+    metrics.close()
+
+    rows = {table: spark.read.parquet(output_data + table + '/').count() for table in TABLES}
+    spark.stop()
+    return rows
+
+
+def redshift_ddl(query):
+    """
+    Rewrites a Redshift CREATE TABLE for Postgres. Redshift does not enforce
+    primary and foreign keys, so they are dropped along with the sort and
+    distribution keys, and IDENTITY becomes a serial column
+    """
+    query = query.replace('INT IDENTITY(0,1)', 'SERIAL')
+    query = re.sub(r'\s(PRIMARY KEY|SORTKEY|DISTSTYLE ALL)\b', ' ', query)
+    return re.sub(r'REFERENCES \w+\(\w+\)', '', query)
+
+
+def redshift_dml(query):
+    """rewrites a Redshift INSERT ... SELECT for Postgres, which spells the day of week DOW"""
+    return query.replace('EXTRACT(WEEKDAY', 'EXTRACT(DOW')
+
+
+def copy_staging(cur, table, columns, records):
+    """COPYs records, lists of values in the order of columns, into table"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in records:
+        writer.writerow(['\\N' if value is None else value for value in record])
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table, ', '.join(columns)), buffer)
+
+
+def load_staging_standin(cur, conn, data_dir):
+    """
+    Stands in for the Redshift COPY from S3: loads the local song and log
+    files into staging_songs and staging_events the way the COPY options
+    in sql_queries.py would, with epoch ms ts and blanks as NULL
+    """
+    song_columns = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude', 'artist_location',
+                    'artist_name', 'song_id', 'title', 'duration', 'year']
+    event_columns = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level',
+                     'location', 'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts',
+                     'userAgent', 'userId']
+
+    def blank_as_null(value):
+        return None if value == '' else value
+
+    songs = []
+    for path in glob.glob(os.path.join(data_dir, 'song_data', '**', '*.json'), recursive=True):
+        with open(path) as f:
+            record = json.load(f)
+        songs.append([blank_as_null(record.get(column)) for column in song_columns])
+    copy_staging(cur, 'staging_songs', song_columns, songs)
+
+    events = []
+    for path in glob.glob(os.path.join(data_dir, 'log_data', '**', '*.json'), recursive=True):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                record['ts'] = datetime.fromtimestamp(record['ts'] / 1000, timezone.utc).strftime(
+                    '%Y-%m-%d %H:%M:%S.%f')
+                if record.get('registration') is not None:
+                    record['registration'] = int(record['registration'])
+                events.append([blank_as_null(record.get(column)) for column in event_columns])
+    copy_staging(cur, 'staging_events', event_columns, events)
+    conn.commit()
+
+
+def redshift_child(args):
+    """
+    Runs the Redshift pipeline against a Postgres stand-in in its own
+    schema: the Redshift DDL and inserts of sql_queries.py are rewritten
+    for Postgres and the staging tables are loaded from the local files
+    """
+    # sql_queries.py reads dwh.cfg at import time; the stand-in does not use its values
+    os.chdir(args.work_dir)
+    with open('dwh.cfg', 'w') as f:
+        f.write('[AWS]\nKEY=\nSECRET=\n[CLUSTER]\nHOST=\nCLUSTER_TYPE=\nNUM_NODES=\nNODE_TYPE=\nIAM_ROLE_NAME=\n'
+                'CLUSTER_IDENTIFIER=\nDB_NAME=\nDB_USER=\nDB_PASSWORD=\nDB_PORT=\n'
+                '[S3]\nLOG_DATA=\nLOG_JSONPATH=\nSONG_DATA=\n[IAM_ROLE]\nARN=\n')
+    sys.path.insert(0, REDSHIFT_DIR)
+    import psycopg2
+    import etl
+    import sql_queries
+    from instrumentation import Instrumentation, instrumented_cursor
+
+    metrics = Instrumentation('redshift', args.metrics_log)
+    metrics.name_statements(sql_queries)
+    for name, query in vars(sql_queries).items():
+        if name.endswith('_insert'):
+            metrics.statement_names[redshift_dml(query)] = name
+
+    conn = psycopg2.connect(args.dsn)
+    cur = instrumented_cursor(conn, metrics)
+    cur.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(REDSHIFT_SCHEMA))
+    cur.execute('SET search_path TO {}'.format(REDSHIFT_SCHEMA))
+    conn.commit()
+
+    with metrics.stage('create_tables'):
+        for query in sql_queries.drop_table_queries + [redshift_ddl(q) for q in sql_queries.create_table_queries]:
+            cur.execute(query)
+        conn.commit()
+
+    with metrics.stage('load_staging_tables'):
+        load_staging_standin(cur, conn, args.data_dir)
+
+    etl.insert_table_queries = [redshift_dml(query) for query in etl.insert_table_queries]
+    etl.insert_tables(cur, conn, metrics)
+
+    conn.close()
+    metrics.close()
+    return count_rows(args.dsn, REDSHIFT_SCHEMA)
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Prints the change in wall time of every run against the same pipeline
+    and size in a baseline results file. Returns the runs slower than the
+    baseline by more than tolerance
+    """
+    with open(baseline_path) as f:
+        baseline = {(run['pipeline'], run['size']): run for run in json.load(f)['runs'] if run['status'] == 'ok'}
+
+    regressions = []
+    for run in results['runs']:
+        before = baseline.get((run['pipeline'], run['size']))
+        if before is None or run['status'] != 'ok':
+            continue
+        change = run['wall_seconds'] / before['wall_seconds'] - 1
+        print('{:<9} {:>10} events: {:8.3f}s -> {:8.3f}s ({:+.1%})'.format(
+            run['pipeline'], run['size'], before['wall_seconds'], run['wall_seconds'], change))
+        if change > tolerance:
+            regressions.append(run)
+    return regressions
+
+
+def parse_args():
+    """parses the command line options of the benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmarks the Sparkify pipelines over generated datasets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='dataset sizes in NextSong events')
+    parser.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=PIPELINES)
+    parser.add_argument('--repeat', type=int, default=1, help='runs of every pipeline per size')
+    parser.add_argument('--work-dir', default='benchmark_runs',
+                        help='directory for the generated data, logs and outputs')
+    parser.add_argument('--output', default=None,
+                        help='results file, defaults to <work-dir>/results-<timestamp>.json')
+    parser.add_argument('--compare', default=None, metavar='RESULTS',
+                        help='results file of an earlier run to compare wall times against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown against --compare reported as a regression, 0.1 is 10%%')
+    parser.add_argument('--dsn', default=None, help='defaults to $SPARKIFY_DSN or the local sparkifydb')
+    parser.add_argument('--admin-dsn', default=None, help='defaults to $SPARKIFY_ADMIN_DSN or the local studentdb')
+    parser.add_argument('--create-tables-args', default='', metavar='ARGS',
+                        help="options for data_modeling_with_postgres/create_tables.py, e.g. "
+                             "--create-tables-args='--bulk-load --partition-songplays'")
+    parser.add_argument('--postgres-args', nargs=argparse.REMAINDER, default=[],
+                        help='extra options for data_modeling_with_postgres/etl.py, e.g. --workers 4')
+    parser.add_argument('--seed', type=int, default=42)
+    # internal: run one pipeline inside a child process
+    parser.add_argument('--child', choices=['spark', 'redshift'], help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--metrics-log', help=argparse.SUPPRESS)
+    parser.add_argument('--rows-file', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    """driver program that generates every dataset, runs the pipelines over it and writes the results"""
+    args = parse_args()
+
+    if args.child:
+        args.dsn = os.environ['SPARKIFY_DSN']
+        rows = spark_child(args) if args.child == 'spark' else redshift_child(args)
+        with open(args.rows_file, 'w') as f:
+            json.dump(rows, f)
+        return
+
+    sys.path.insert(0, POSTGRES_DIR)
+    from db import get_dsn, get_admin_dsn
+    args.dsn = get_dsn(args.dsn)
+    args.admin_dsn = get_admin_dsn(args.admin_dsn)
+    args.work_dir = os.path.abspath(args.work_dir)
+    started = datetime.now(timezone.utc)
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECTS_DIR,
+                                         universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    results = {
+        'started': started.isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'create_tables_args': args.create_tables_args,
+        'postgres_args': args.postgres_args,
+        'runs': []
+    }
+
+    for size in args.sizes:
+        data_dir = os.path.join(args.work_dir, 'data-{}'.format(size))
+        summary = prepare_dataset(data_dir, size, args.seed)
+
+        for repeat in range(args.repeat):
+            for pipeline in args.pipelines:
+                run_dir = os.path.join(args.work_dir, 'run-{}-{}-{}'.format(started.strftime('%Y%m%dT%H%M%S'),
+                                                                            size, repeat))
+                run = run_pipeline(pipeline, size, data_dir, run_dir, summary, args)
+                run['repeat'] = repeat
+                results['runs'].append(run)
+                print('{pipeline} {size} events: {status} in {wall_seconds}s, {rows_per_second} rows/s, '
+                      'peak RSS {peak_rss_mb} MB, log in {log}'.format(**run))
+
+    output = args.output or os.path.join(args.work_dir, 'results-{}.json'.format(started.strftime('%Y%m%dT%H%M%S')))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to {}'.format(output))
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import glob
+import json
+import argparse
+import hashlib
+from record_cache import arrow_schema
+
+# Rolls a song_data tree of one small JSON file per song into a few large
+# NDJSON or parquet shards described by a _manifest.json. The Spark and
+# Postgres pipelines read the shards listed in the manifest instead of
+# listing and opening every song file. Names starting with '_' are skipped
+# by Spark and Hadoop directory listings, so the manifest is never read as data
+
+MANIFEST_NAME = '_manifest.json'
+FORMATS = ['ndjson', 'parquet']
+SHARD_EXTENSIONS = {'ndjson': '.ndjson', 'parquet': '.parquet'}
+
+
+def song_files(source):
+    """returns the paths of the JSON files under source in sorted order"""
+    return sorted(glob.glob(os.path.join(source, '**', '*.json'), recursive=True))
+
+
+def read_song_lines(filepath):
+    """returns the non-empty lines of a song file, parsing each so malformed files fail here"""
+    with open(filepath) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    for line in lines:
+        json.loads(line)
+    return lines
+
+
+def write_ndjson_shard(path, lines):
+    """writes the records of a shard one JSON object per line, as they were in the song files"""
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def write_parquet_shard(path, lines):
+    """writes the records of a shard as a parquet file with the song record types of record_cache.py"""
+    # only the parquet format needs pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    records = [json.loads(line) for line in lines]
+    pq.write_table(pa.Table.from_pylist(records, schema=arrow_schema('song')), path)
+
+
+def file_md5(path):
+    """returns the md5 hex digest of the contents of path"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compact(source, target, fmt='ndjson', shard_mb=128):
+    """
+    Writes the records of every song file under source into shards of about
+    shard_mb MB of source JSON each, part-00000.ndjson or .parquet, and a
+    manifest listing the shards with their record count, size and md5.
+    Earlier shards in target are removed first. Files that fail to parse are
+    left out and listed in the manifest. Returns the manifest
+    """
+    os.makedirs(target, exist_ok=True)
+    for old in glob.glob(os.path.join(target, 'part-*')):
+        os.remove(old)
+
+    write_shard = write_parquet_shard if fmt == 'parquet' else write_ndjson_shard
+    shards, failed = [], []
+    files = song_files(source)
+    lines, shard_bytes, shard_files = [], 0, 0
+
+    def flush():
+        """writes the pending lines as the next shard"""
+        name = 'part-{:05d}{}'.format(len(shards), SHARD_EXTENSIONS[fmt])
+        path = os.path.join(target, name)
+        write_shard(path, lines)
+        shards.append({'path': name, 'records': len(lines), 'source_files': shard_files,
+                       'bytes': os.path.getsize(path), 'md5': file_md5(path)})
+
+    for filepath in files:
+        try:
+            file_lines = read_song_lines(filepath)
+        except (ValueError, UnicodeDecodeError) as e:
+            print('failed to read {}: {}'.format(filepath, e))
+            failed.append(os.path.relpath(filepath, source))
+            continue
+        lines += file_lines
+        shard_bytes += os.path.getsize(filepath)
+        shard_files += 1
+        if shard_bytes >= shard_mb * 1024 * 1024:
+            flush()
+            lines, shard_bytes, shard_files = [], 0, 0
+    if lines:
+        flush()
+
+    manifest = {'format': fmt, 'source': os.path.abspath(source), 'source_files': len(files),
+                'records': sum(shard['records'] for shard in shards), 'failed': failed, 'shards': shards}
+    with open(os.path.join(target, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    """driver program that compacts a song_data tree into shards"""
+    parser = argparse.ArgumentParser(description='Compacts song_data into a few large shards with a manifest')
+    parser.add_argument('source', help='song_data directory, e.g. data/song_data')
+    parser.add_argument('target', help='directory that receives the shards and ' + MANIFEST_NAME)
+    parser.add_argument('--format', choices=FORMATS, default='ndjson',
+                        help="'ndjson' keeps the JSON records, 'parquet' needs pyarrow")
+    parser.add_argument('--shard-mb', type=int, default=128, help='source JSON per shard in MB')
+    args = parser.parse_args()
+
+    manifest = compact(args.source, args.target, args.format, args.shard_mb)
+    print('{} records of {} files in {} shards, {} files failed'.format(
+        manifest['records'], manifest['source_files'], len(manifest['shards']), len(manifest['failed'])))
+
+
+if __name__ == "__main__":
+    main()
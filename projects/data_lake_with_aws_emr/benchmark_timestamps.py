@@ -0,0 +1,76 @@
+import argparse
+import time
+from datetime import datetime
+from pyspark.sql.types import TimestampType
+import pyspark.sql.functions as F
+from etl import create_spark_session, epoch_ms_to_timestamp
+
+
+def python_udf_timestamp(column):
+    """
+    Description:
+        The former conversion of process_log_data: a Python UDF that ships
+        every value to a Python worker and back, in the worker's local time
+    :param column: column of epoch milliseconds
+    """
+    get_timestamp = F.udf(lambda x: datetime.fromtimestamp(x/1000.0), TimestampType())
+    return get_timestamp(column)
+
+
+def time_conversion(df, convert, repeat):
+    """
+    Description:
+        Return the best time in seconds over repeat runs of deriving the time
+        table fields from a converted ts column, aggregated so every row is
+        converted without writing any output
+    :param df: DataFrame with a ts column
+    :param convert: function turning the ts column into a timestamp column
+    :param repeat: number of runs
+    """
+    start_time = convert(F.col("ts"))
+    fields = [F.hour(start_time), F.dayofmonth(start_time), F.weekofyear(start_time),
+              F.month(start_time), F.year(start_time), F.dayofweek(start_time)]
+    query = df.select(sum(fields[1:], fields[0]).alias("fields")).agg(F.sum("fields"))
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        query.collect()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """
+    Description:
+        driver program that compares the Python UDF and the native timestamp
+        conversion on the NextSong events of a log_data directory, e.g. the
+        output of ../generate_data.py --layout flat
+    """
+    parser = argparse.ArgumentParser(description='Compares the UDF and the native ts conversion')
+    parser.add_argument('--input', default='data/log_data')
+    parser.add_argument('--master', default='local[*]')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # the job's own session settings, without the S3 package, so the benchmark runs offline
+    spark = create_spark_session(args.master, {"spark.app.name": "timestamp-benchmark"}, s3=False)
+
+    # parse the input once so both runs only pay for the conversion
+    df = spark.read.json(args.input.rstrip('/') + '/*.json').where(F.col("page") == 'NextSong').select("ts").cache()
+    rows = df.count()
+
+    native = time_conversion(df, epoch_ms_to_timestamp, args.repeat)
+    udf = time_conversion(df, python_udf_timestamp, args.repeat)
+    mismatches = df.where(epoch_ms_to_timestamp(F.col("ts")) != python_udf_timestamp(F.col("ts"))).count()
+
+    print('{} NextSong events'.format(rows))
+    print('python udf: {:.2f}s ({:.0f} rows/s)'.format(udf, rows / udf))
+    print('native:     {:.2f}s ({:.0f} rows/s)'.format(native, rows / native))
+    print('speedup: {:.1f}x'.format(udf / native))
+    print('{} rows differ, the udf uses the local time zone of the Python workers'.format(mismatches))
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
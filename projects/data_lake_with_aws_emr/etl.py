@@ -1,46 +1,526 @@
+import argparse
 import configparser
-from datetime import datetime
+import glob
+import json
 import os
+import sys
+from datetime import date, timedelta
+from contextlib import nullcontext
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.types import TimestampType
-from pyspark.sql.window import Window
+from pyspark.sql.types import (StructType, StructField, StringType, DoubleType, LongType,
+                               TimestampType)
 import pyspark.sql.functions as F
+# modules shared by the projects, such as instrumentation.py and record_cache.py, live in projects/
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Instrumentation
+from record_cache import RecordCache, RECORD_FIELDS
+from compact_song_data import MANIFEST_NAME
 
 
-config = configparser.ConfigParser()
-config.read_file(open('dl.cfg'))
+# Spark types of the arrow types in RECORD_FIELDS
+SPARK_TYPES = {"string": StringType(), "int64": LongType(), "float64": DoubleType()}
 
-os.environ['AWS_ACCESS_KEY_ID']=config.get("AWS", "AWS_ACCESS_KEY_ID")
-os.environ['AWS_SECRET_ACCESS_KEY']=config.get("AWS", "AWS_SECRET_ACCESS_KEY")
+# fields of a song_data record and of a log_data event, as typed by ../record_cache.py;
+# reading with a schema skips the inference pass over every file
+SONG_SCHEMA = StructType([StructField(name, SPARK_TYPES[type_name]) for name, type_name in RECORD_FIELDS["song"]])
+LOG_SCHEMA = StructType([StructField(name, SPARK_TYPES[type_name]) for name, type_name in RECORD_FIELDS["log"]])
 
-def create_spark_session():
+# strict fails on the first malformed record, permissive drops or quarantines them
+READ_MODES = ["strict", "permissive"]
+CORRUPT_RECORD_COLUMN = "_corrupt_record"
+
+# partition columns of the songs table; a directory per artist means a file per artist and year
+SONGS_PARTITIONINGS = {"year_artist": ["year", "artist_id"], "year": ["year"], "none": []}
+
+# parquet files below this size are counted as small in the post-write report
+SMALL_FILE_BYTES = 32 * 1024 * 1024
+
+# rough ratio of Spark's in-memory size estimate of a table to its size as
+# snappy parquet, used to turn --target-file-mb into tasks or rows per file
+PLAN_BYTES_PER_PARQUET_BYTE = 4
+
+# overwrite rebuilds every table, incremental only replaces the partitions the input touches
+WRITE_MODES = ["overwrite", "incremental"]
+
+# storage levels the song data can be persisted at, NONE reads it again for each use
+STORAGE_LEVELS = ["NONE", "MEMORY_ONLY", "MEMORY_AND_DISK", "DISK_ONLY", "OFF_HEAP"]
+
+# fields of a log event that identify it, hashed into its songplay_id
+SONGPLAY_KEY_COLUMNS = ["ts", "userId", "sessionId", "itemInSession"]
+
+def load_aws_config(path='dl.cfg'):
+    """
+    Description:
+        Export the AWS keys of the config file at path for the S3 reads and
+        writes. Without the file the keys already in the environment, or the
+        EMR instance role, are used
+    :param path: config file with an [AWS] section
+    """
+    if not os.path.exists(path):
+        return
+    config = configparser.ConfigParser()
+    config.read_file(open(path))
+
+    os.environ['AWS_ACCESS_KEY_ID']=config.get("AWS", "AWS_ACCESS_KEY_ID")
+    os.environ['AWS_SECRET_ACCESS_KEY']=config.get("AWS", "AWS_SECRET_ACCESS_KEY")
+
+def create_spark_session(master=None, conf=None, s3=True):
     """
     Description:
         Create and return SparkSession object for downstream jobs to utilize
+    :param master: Spark master, e.g. local[*], or None to take it from spark-submit
+    :param conf: dict of further Spark settings
+    :param s3: load the hadoop-aws package that provides s3a:// paths
     """
-    spark = SparkSession \
-        .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+    builder = SparkSession.builder.config("spark.sql.session.timeZone", "UTC")
+    if master:
+        builder = builder.master(master)
+    if s3:
+        builder = builder.config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0")
+    for key, value in (conf or {}).items():
+        builder = builder.config(key, value)
+    spark = builder.getOrCreate()
     return spark
 
-def process_song_data(spark, input_data, output_data):
+def spark_settings(args):
+    """
+    Description:
+        Return the Spark settings given on the command line as a dict. Only
+        the options that were given are set, and --conf values come last
+    :param args: parsed command line options
+    """
+    conf = {}
+    if args.shuffle_partitions:
+        conf["spark.sql.shuffle.partitions"] = str(args.shuffle_partitions)
+    if args.executor_memory:
+        conf["spark.executor.memory"] = args.executor_memory
+    if args.driver_memory:
+        conf["spark.driver.memory"] = args.driver_memory
+    if args.broadcast_threshold_mb is not None:
+        threshold = args.broadcast_threshold_mb * 1024 * 1024 if args.broadcast_threshold_mb >= 0 else -1
+        conf["spark.sql.autoBroadcastJoinThreshold"] = str(threshold)
+    if args.max_records_per_file is not None:
+        conf["spark.sql.files.maxRecordsPerFile"] = str(args.max_records_per_file)
+    for setting in args.conf:
+        key, _, value = setting.partition('=')
+        conf[key] = value
+    return conf
+
+def epoch_ms_to_timestamp(column):
+    """
+    Description:
+        Convert a column of epoch milliseconds into a timestamp with a native
+        cast, which runs inside the JVM instead of a Python UDF. Hour, day and
+        the other fields are then taken in the session time zone, UTC
+    :param column: column of epoch milliseconds
+    """
+    # dividing as a decimal keeps the milliseconds exact, a double could round 0.26s down to 0.259999s
+    return (column.cast("decimal(20,0)") / 1000).cast(TimestampType())
+
+def songplay_id(*columns):
+    """
+    Description:
+        Derive the songplay_id from the columns identifying an event, as the
+        first 60 bits of the SHA-256 of their values. Every row is hashed in
+        its own partition, so no window moves the fact rows to a single
+        executor, and reruns over the same events give the same ids. The
+        chance of any collision among n events is about n^2 / 2^61, under
+        1e-4 for ten million songplays
+    :param columns: names of the identifying columns
+    """
+    key = F.concat_ws("|", *[F.col(column).cast("string") for column in columns])
+    return F.conv(F.substring(F.sha2(key, 256), 1, 15), 16, 10).cast("long")
+
+def hadoop_path(spark, path):
+    """
+    Description:
+        Return the Hadoop FileSystem holding path and path as a Hadoop Path,
+        so files are listed, renamed and deleted the same way on local paths and S3
+    :param spark: a spark session instance
+    :param path: file, directory or glob
+    """
+    path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return path.getFileSystem(spark._jsc.hadoopConfiguration()), path
+
+def input_bytes(spark, pattern):
+    """
+    Description:
+        Return the total size of the files matching a glob pattern, or a list
+        of them, listed through the Hadoop FileSystem
+    :param spark: a spark session instance
+    :param pattern: input file glob or list of globs
+    """
+    total = 0
+    for glob in ([pattern] if isinstance(pattern, str) else pattern):
+        fs, path = hadoop_path(spark, glob)
+        total += sum(status.getLen() for status in fs.globStatus(path) or [])
+    return total
+
+def path_exists(spark, pattern):
+    """
+    Description:
+        Return whether any file or directory matches pattern
+    :param spark: a spark session instance
+    :param pattern: path or glob
+    """
+    fs, path = hadoop_path(spark, pattern)
+    return bool(fs.globStatus(path))
+
+def log_data_paths(spark, input_data, start_date=None, end_date=None, whole_months=False):
+    """
+    Description:
+        Return the log_data files to read: all of them without a date range,
+        else the YYYY-MM-DD-events.json files from start_date to end_date that
+        exist. With whole_months the range is widened to one glob per calendar
+        month, so every (year, month) partition written is rebuilt from all of
+        its events
+    :param spark: a spark session instance
+    :param input_data: input file path
+    :param start_date: first date to read, or None for all of log_data
+    :param end_date: last date to read, start_date if None
+    :param whole_months: read the whole months of the range
+    """
+    if start_date is None:
+        return [input_data + 'log_data/*.json']
+    end_date = end_date or start_date
+    if whole_months:
+        paths, year, month = [], start_date.year, start_date.month
+        while (year, month) <= (end_date.year, end_date.month):
+            paths.append(input_data + 'log_data/{:04d}-{:02d}-*-events.json'.format(year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    else:
+        days = range((end_date - start_date).days + 1)
+        paths = [input_data + 'log_data/{}-events.json'.format(start_date + timedelta(days=day)) for day in days]
+    # Spark fails on a path that matches nothing, e.g. a day without events
+    return [path for path in paths if path_exists(spark, path)]
+
+def plan_bytes(df):
+    """
+    Description:
+        Return Spark's estimate of the size of df in bytes, taken from the
+        statistics of its optimized plan without running it. The estimate is
+        of the rows in memory, so it is an upper bound of the parquet size
+    :param df: a DataFrame
+    """
+    return int(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString())
+
+def apply_layout(df, partition_by, layout=None):
+    """
+    Description:
+        Return df repartitioned for its write as set by layout, a dict with
+        the optional keys repartition and target_file_mb, and the number of
+        rows per file to cap the write at, or None. Repartitioning by the
+        partition columns sends all rows of a partition value to one task,
+        which then writes one file per output directory instead of one per
+        task. With target_file_mb, an unpartitioned table gets as many tasks
+        as its plan estimate needs for files of about that size. A partitioned
+        table is repartitioned by its partition columns, and the files of each
+        directory are capped at the rows that fit in that size, from the
+        estimated row size of the schema. Both estimates are of the rows in
+        memory and are divided by PLAN_BYTES_PER_PARQUET_BYTE
+    :param df: table to write
+    :param partition_by: partition columns of the table
+    :param layout: dict of layout options, or None to write df as is
+    """
+    layout = layout or {}
+    if layout.get("target_file_mb"):
+        target_bytes = layout["target_file_mb"] * 1024 * 1024 * PLAN_BYTES_PER_PARQUET_BYTE
+        if partition_by:
+            row_bytes = df._jdf.schema().defaultSize()
+            return df.repartition(*partition_by), max(1, target_bytes // row_bytes)
+        return df.repartition(max(1, -(-plan_bytes(df) // target_bytes))), None
+    if layout.get("repartition") and partition_by:
+        return df.repartition(*partition_by), None
+    return df, None
+
+def write_table(df, path, partition_by=(), layout=None):
+    """
+    Description:
+        Overwrite the parquet table at path with df, laid out by apply_layout.
+        The number of rows per file is capped by spark.sql.files.maxRecordsPerFile,
+        or by the cap apply_layout derives from target_file_mb
+    :param df: table to write
+    :param path: table directory
+    :param partition_by: partition columns of the table
+    :param layout: dict of layout options, see apply_layout
+    """
+    df, max_records = apply_layout(df, list(partition_by), layout)
+    writer = df.write.mode("overwrite")
+    if max_records:
+        writer = writer.option("maxRecordsPerFile", max_records)
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(path)
+
+def merge_table(spark, df, path, layout=None):
+    """
+    Description:
+        Write df to the unpartitioned parquet table at path, keeping the rows
+        already there. Every distinct row is kept once, as a full rebuild would.
+        The merged table is written next to path and swapped in, since Spark
+        cannot overwrite a path it is reading from
+    :param spark: a spark session instance
+    :param df: new rows
+    :param path: table directory
+    :param layout: dict of layout options, see apply_layout
+    """
+    if not path_exists(spark, path):
+        write_table(df, path, layout=layout)
+        return
+    staging = path.rstrip('/') + '_merge/'
+    write_table(spark.read.parquet(path).unionByName(df).drop_duplicates(), staging, layout=layout)
+    fs, table = hadoop_path(spark, path)
+    fs.delete(table, True)
+    fs.rename(hadoop_path(spark, staging)[1], table)
+
+def file_report(spark, path):
+    """
+    Description:
+        Return the number of parquet files under path, their partition
+        directories and the distribution of their sizes in bytes
+    :param spark: a spark session instance
+    :param path: output path of the table
+    """
+    fs, root = hadoop_path(spark, path)
+    sizes, directories = [], set()
+    files = fs.listFiles(root, True)
+    while files.hasNext():
+        status = files.next()
+        if status.getPath().getName().endswith('.parquet'):
+            sizes.append(status.getLen())
+            directories.add(status.getPath().getParent().toString())
+    sizes.sort()
+    return {'files': len(sizes), 'directories': len(directories), 'bytes': sum(sizes),
+            'min': sizes[0] if sizes else 0, 'median': sizes[len(sizes) // 2] if sizes else 0,
+            'max': sizes[-1] if sizes else 0,
+            'small_files': sum(size < SMALL_FILE_BYTES for size in sizes)}
+
+def format_size(size):
+    """
+    Description:
+        Return size in bytes as a short human readable string
+    :param size: number of bytes
+    """
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f} GB'.format(size)
+
+def write_stage(spark, metrics, name, write, path):
+    """
+    Description:
+        Run a table write, then print the file count and size distribution of
+        the table. When metrics is given the write is a metrics stage, the
+        rows written are counted back from the parquet footers under path and
+        the file count and size are added to the stage as labels
+    :param spark: a spark session instance
+    :param metrics: an Instrumentation or None
+    :param name: stage name
+    :param write: function performing the write
+    :param path: output path of the table
+    """
+    with stage(metrics, name) as counts:
+        write()
+        report = file_report(spark, path)
+        if metrics is not None:
+            counts['rows'] = spark.read.parquet(path).count()
+            counts['files'] = report['files']
+            counts['output_bytes'] = report['bytes']
+    print('{}: {} files in {} directories, {} total, min {} / median {} / max {}, {} files under {}'.format(
+        name, report['files'], report['directories'], format_size(report['bytes']),
+        format_size(report['min']), format_size(report['median']), format_size(report['max']),
+        report['small_files'], format_size(SMALL_FILE_BYTES)))
+
+def read_stage(spark, metrics, name, read, pattern):
+    """
+    Description:
+        Run a json read as a metrics stage recording the bytes of its input
+        files, and return the DataFrame. Reads are lazy, so the stage times
+        the schema inference pass while the scan itself is part of the writes
+    :param spark: a spark session instance
+    :param metrics: an Instrumentation or None
+    :param name: stage name
+    :param read: function returning the DataFrame
+    :param pattern: input file glob or list of globs
+    """
+    if metrics is None:
+        return read()
+    with metrics.stage(name) as counts:
+        df = read()
+        counts['bytes'] = input_bytes(spark, pattern)
+    return df
+
+def log_join_plan(df):
+    """
+    Description:
+        Print the join strategy and physical plan Spark chose for df, e.g. to
+        check that the songplays join was broadcast
+    :param df: a DataFrame with a join
+    """
+    plan = df._jdf.queryExecution().executedPlan().toString()
+    strategies = [name for name in ["BroadcastHashJoin", "SortMergeJoin", "ShuffledHashJoin",
+                                    "BroadcastNestedLoopJoin"] if name in plan]
+    print('songplays join: {}'.format(', '.join(strategies) or 'none'))
+    print(plan)
+
+def stage(metrics, name):
+    """
+    Description:
+        Return a metrics stage named name, or a context doing nothing when
+        metrics is None
+    :param metrics: an Instrumentation or None
+    :param name: stage name
+    """
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+def read_json(spark, path, schema, read_mode="permissive", quarantine_path=None, metrics=None):
+    """
+    Description:
+        Read JSON files with an explicit schema, so no inference pass runs
+        over the input. In strict mode the first malformed record fails the
+        job. In permissive mode malformed records, including values that do
+        not fit the schema, are dropped; with a quarantine_path they are
+        first written there as parquet with their raw text and source file
+    :param spark: a spark session instance
+    :param path: input file glob or list of globs
+    :param schema: StructType of the records
+    :param read_mode: strict or permissive
+    :param quarantine_path: output path for the malformed records, or None
+    :param metrics: optional Instrumentation timing the quarantine write
+    """
+    if read_mode == "strict":
+        return spark.read.schema(schema).option("mode", "FAILFAST").json(path)
+    if quarantine_path is None:
+        return spark.read.schema(schema).option("mode", "DROPMALFORMED").json(path)
+
+    df = spark.read.schema(StructType(schema.fields + [StructField(CORRUPT_RECORD_COLUMN, StringType())])) \
+        .option("mode", "PERMISSIVE") \
+        .option("columnNameOfCorruptRecord", CORRUPT_RECORD_COLUMN) \
+        .json(path) \
+        .withColumn("source_file", F.input_file_name())
+    # select every column, Spark refuses queries over raw JSON that reference only the corrupt record column
+    corrupt = df.where(F.col(CORRUPT_RECORD_COLUMN).isNotNull())
+    write_stage(spark, metrics, 'quarantine_' + os.path.basename(quarantine_path.rstrip('/')),
+                lambda: corrupt.write.mode("overwrite").parquet(quarantine_path),
+                quarantine_path)
+    return df.where(F.col(CORRUPT_RECORD_COLUMN).isNull()).drop(CORRUPT_RECORD_COLUMN, "source_file")
+
+def read_compaction_manifest(spark, song_dir):
+    """
+    Description:
+        Return the manifest of a song_data directory compacted by
+        ../compact_song_data.py, or None for a directory of song files
+    :param spark: a spark session instance
+    :param song_dir: song_data directory
+    """
+    manifest = song_dir + MANIFEST_NAME
+    if not path_exists(spark, manifest):
+        return None
+    return json.loads('\n'.join(spark.sparkContext.textFile(manifest).collect()))
+
+def local_files(patterns):
+    """
+    Description:
+        Return the local files matching a glob pattern, or a list of them, in sorted order
+    :param patterns: file glob or list of globs
+    """
+    patterns = [patterns] if isinstance(patterns, str) else patterns
+    return sorted(path for pattern in patterns for path in glob.glob(pattern))
+
+def read_cached(spark, cache, kind, patterns, schema, read_files):
+    """
+    Description:
+        Read the records of the local files matching patterns from a
+        RecordCache filled by the Postgres ETL or record_cache.py, so cached
+        files are not parsed again. Each entry holds the records of one file,
+        and the files not in the cache are read with read_files
+    :param spark: a spark session instance
+    :param cache: a RecordCache
+    :param kind: song or log
+    :param patterns: input file glob or list of globs
+    :param schema: StructType of the records
+    :param read_files: function reading a list of files into a DataFrame of schema
+    """
+    files = local_files(patterns)
+    entries, missing = cache.lookup(kind, files)
+    print('record cache: {} of {} {} files cached'.format(len(entries), len(files), kind))
+
+    frames = []
+    if entries:
+        cached = spark.read.parquet(*entries)
+        frames.append(cached.select([F.col(field.name).cast(field.dataType) for field in schema.fields]))
+    if missing or not frames:
+        frames.append(read_files(missing) if missing else spark.createDataFrame([], schema))
+    df = frames[0]
+    for frame in frames[1:]:
+        df = df.unionByName(frame)
+    return df
+
+def read_song_data(spark, input_data, storage_level="MEMORY_AND_DISK", metrics=None,
+                   read_mode="permissive", quarantine_data=None, song_dir=None, cache=None):
+    """
+    Description:
+        Read the song data files once with SONG_SCHEMA and persist them at
+        storage_level, so the songs, artists and songplays builds share a
+        single listing and scan of song_data. A directory compacted by
+        ../compact_song_data.py is read from the shards in its manifest,
+        parquet shards with the types of SONG_SCHEMA and no read mode
+    :param spark: a spark session instance
+    :param input_data: input S3 file path
+    :param storage_level: name of a pyspark StorageLevel, or NONE to not persist
+    :param metrics: optional Instrumentation timing the read
+    :param read_mode: strict or permissive, see read_json
+    :param quarantine_data: path receiving malformed records under song_data/, or None
+    :param song_dir: song_data directory, input_data/song_data/ if None
+    :param cache: RecordCache of parsed records for local input, or None
+    """
+    song_dir = song_dir.rstrip('/') + '/' if song_dir else input_data + 'song_data/'
+    quarantine_path = quarantine_data + 'song_data/' if quarantine_data else None
+    manifest = read_compaction_manifest(spark, song_dir)
+    if manifest is None:
+        song_data = song_dir + '*/*/*/*.json'
+    else:
+        song_data = [song_dir + shard['path'] for shard in manifest['shards']]
+
+    def read_files(paths):
+        """reads song files or shards without the cache"""
+        if manifest is not None and manifest['format'] == 'parquet':
+            return spark.read.parquet(*paths) \
+                .select([F.col(field.name).cast(field.dataType) for field in SONG_SCHEMA.fields])
+        return read_json(spark, paths, SONG_SCHEMA, read_mode, quarantine_path, metrics)
+
+    # only compacted shards are cached, an entry per song file would bring back the small files
+    read = lambda: read_files(song_data) if cache is None or manifest is None \
+        else read_cached(spark, cache, 'song', song_data, SONG_SCHEMA, read_files)
+    df = read_stage(spark, metrics, 'read_song_data', lambda: read().drop_duplicates(), song_data)
+    if storage_level != "NONE":
+        df = df.persist(getattr(StorageLevel, storage_level))
+    return df
+
+def process_song_data(spark, input_data, output_data, metrics=None, song_df=None, layout=None,
+                      songs_partition_by=("year", "artist_id")):
     """
     Description:
         Process the songs data files and create extract songs table and artist table data from it.
     :param spark: a spark session instance
     :param input_data: input S3 file path
     :param output_data: output S3 file path
+    :param metrics: optional Instrumentation timing the reads and writes
+    :param song_df: song data returned by read_song_data, read here if not given
+    :param layout: dict of output layout options, see apply_layout
+    :param songs_partition_by: partition columns of the songs table
     """
-    # get filepath to song data file
-    song_data = input_data + 'song_data/*/*/*/*.json'
     # read song data file
-    df = spark.read.json(song_data).drop_duplicates()
+    df = song_df if song_df is not None else read_song_data(spark, input_data, "NONE", metrics)
     # extract columns to create songs table
     songs_table = df.select("song_id", "title", "artist_id", "year", "duration").drop_duplicates()
 
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.mode("overwrite").partitionBy("year", "artist_id").parquet(output_data + 'songs/')
+    # write songs table to parquet files partitioned by year and artist, unless set otherwise
+    write_stage(spark, metrics, 'write_songs',
+                lambda: write_table(songs_table, output_data + 'songs/', songs_partition_by, layout),
+                output_data + 'songs/')
     
 
     # extract columns to create artists table
@@ -48,22 +528,42 @@ def process_song_data(spark, input_data, output_data):
     
     
     # write artists table to parquet files
-    artists_table.write.mode("overwrite").parquet(output_data + 'artists/')
+    write_stage(spark, metrics, 'write_artists',
+                lambda: write_table(artists_table, output_data + 'artists/', layout=layout),
+                output_data + 'artists/')
     
     
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, input_data, output_data, metrics=None, song_df=None,
+                     read_mode="permissive", quarantine_data=None, log_paths=None, incremental=False,
+                     layout=None, cache=None):
     """
     Description:
             Process the event log file and extract data for table time, users and songplays from it.
     :param spark: a spark session instance
     :param input_data: input S3 file path
     :param output_data: output S3 file path
+    :param metrics: optional Instrumentation timing the reads and writes
+    :param song_df: song data returned by read_song_data, read here if not given
+    :param read_mode: strict or permissive, see read_json
+    :param quarantine_data: path receiving malformed records under log_data/, or None
+    :param log_paths: log files to read, see log_data_paths, all of log_data if None
+    :param incremental: merge the users into the existing table; the partitioned
+        tables are replaced per partition when partitionOverwriteMode is dynamic
+    :param layout: dict of output layout options, see apply_layout
+    :param cache: RecordCache of parsed records for local input, or None
     """
     # get filepath to log data file
-    log_data = input_data + 'log_data/*.json'
+    log_data = log_paths if log_paths is not None else [input_data + 'log_data/*.json']
+    if not log_data:
+        print('no log_data in the selected date range')
+        return
 
     # read log data file
-    df = spark.read.json(log_data).drop_duplicates()
+    quarantine_path = quarantine_data + 'log_data/' if quarantine_data else None
+    read_files = lambda paths: read_json(spark, paths, LOG_SCHEMA, read_mode, quarantine_path, metrics)
+    read = lambda: read_files(log_data) if cache is None \
+        else read_cached(spark, cache, 'log', log_data, LOG_SCHEMA, read_files)
+    df = read_stage(spark, metrics, 'read_log_data', lambda: read().drop_duplicates(), log_data)
     
     
     # filter by actions for song plays
@@ -73,12 +573,14 @@ def process_log_data(spark, input_data, output_data):
     users_table = df.selectExpr("userId as user_id", "firstName as first_name", "lastName as last_name", "gender", "level").drop_duplicates()
     
     # write users table to parquet files
-    users_table.write.mode("overwrite").parquet(output_data + 'users/')
+    write_stage(spark, metrics, 'write_users',
+                lambda: merge_table(spark, users_table, output_data + 'users/', layout) if incremental
+                else write_table(users_table, output_data + 'users/', layout=layout),
+                output_data + 'users/')
     
 
-    # create timestamp scolumn from original timestamp column
-    get_timestamp = F.udf(lambda x: datetime.fromtimestamp(x/1000.0), TimestampType())
-    df = df.withColumn("timestamp", get_timestamp(F.col("ts")))
+    # create timestamp column from original timestamp column
+    df = df.withColumn("timestamp", epoch_ms_to_timestamp(F.col("ts")))
 
     
     # extract columns to create time table
@@ -93,40 +595,164 @@ def process_log_data(spark, input_data, output_data):
     
     
     # write time table to parquet files partitioned by year and month
-    time_table.write.mode("overwrite").partitionBy("year", "month").parquet(output_data + 'time/')
+    write_stage(spark, metrics, 'write_time',
+                lambda: write_table(time_table, output_data + 'time/', ["year", "month"], layout),
+                output_data + 'time/')
 
-    # read in song data to use for songplays table
-    #rename year column to avoid ambiguous selection joining to time_table downstream
-    song_df = spark.read.json(input_data + 'song_data/*/*/*/*.json').withColumnRenamed("year", "song_year").drop_duplicates()
+    # reuse the song data read for the songs table, if given
+    if song_df is None:
+        song_df = read_song_data(spark, input_data, "NONE", metrics, read_mode, quarantine_data, cache=cache)
+
+    # only the join keys and ids of the songs are needed, once per key; this small
+    # side is broadcast when below spark.sql.autoBroadcastJoinThreshold. A title and
+    # artist can belong to several songs, so the smallest (song_id, artist_id) is kept,
+    # otherwise an event would become several songplays with the same songplay_id
+    song_keys = song_df.groupBy("title", "artist_name") \
+        .agg(F.min(F.struct("song_id", "artist_id")).alias("match")) \
+        .select("title", "artist_name", "match.song_id", "match.artist_id")
 
-    #create unique songplay_id
-    window_spec = Window.orderBy(F.lit('A'))
     # extract columns from joined song and log datasets to create songplays table 
-    #join to timetable to get year and month partition information 
-    songplays_table = df.join(song_df, (df.song == song_df.title) & (df.artist == song_df.artist_name), 'inner')\
-        .join(time_table, df.timestamp == time_table.start_time, 'inner')\
-        .withColumn("songplay_id", F.row_number().over(window_spec))\
-        .selectExpr("songplay_id", "start_time", "userId as user_id", "level", "song_id", "artist_id", "sessionId as session_id", "location", "userAgent as user_agent", "year", "month")
+    # year and month partition information is derived from the timestamp, no join to the time table needed
+    songplays_table = df.join(song_keys, (df.song == song_keys.title) & (df.artist == song_keys.artist_name), 'inner')\
+        .withColumn("songplay_id", songplay_id(*SONGPLAY_KEY_COLUMNS))\
+        .withColumn("year", F.year("timestamp"))\
+        .withColumn("month", F.month("timestamp"))\
+        .selectExpr("songplay_id", "timestamp as start_time", "userId as user_id", "level", "song_id", "artist_id", "sessionId as session_id", "location", "userAgent as user_agent", "year", "month")
+    log_join_plan(songplays_table)
         
 
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.drop_duplicates().write.mode("overwrite").partitionBy("year", "month").parquet(output_data + 'songplays/')
+    write_stage(spark, metrics, 'write_songplays',
+                lambda: write_table(songplays_table.drop_duplicates(), output_data + 'songplays/', ["year", "month"], layout),
+                output_data + 'songplays/')
+
 
 
+def parse_args():
+    """
+    Description:
+        parse the command line options of the job
+    """
+    parser = argparse.ArgumentParser(description='Builds the Sparkify data lake tables')
+    parser.add_argument('--input-data', default="s3a://udacity-dend/",
+                        help='directory holding song_data/ and log_data/, e.g. data/ for the bundled sample')
+    parser.add_argument('--output-data', default="s3a://sparkify-mglaros-data-lake/",
+                        help='directory receiving the table directories')
+    parser.add_argument('--song-data', default=None,
+                        help='song_data directory or shards written by ../compact_song_data.py, '
+                             'defaults to INPUT_DATA/song_data/')
+    parser.add_argument('--cache-dir', default=None, metavar='PATH',
+                        help='read the log records and song shards already parsed into the parquet record cache '
+                             'at PATH by the Postgres ETL or record_cache.py; local input only')
+    parser.add_argument('--config', default='dl.cfg',
+                        help='file with the AWS keys, read only when a path is on S3')
+    parser.add_argument('--master', default=None,
+                        help='Spark master, e.g. local[*]; by default the one given to spark-submit')
+    parser.add_argument('--shuffle-partitions', type=int, default=None,
+                        help='spark.sql.shuffle.partitions, e.g. the number of cores for small local runs')
+    parser.add_argument('--executor-memory', default=None, help='spark.executor.memory, e.g. 4g')
+    parser.add_argument('--driver-memory', default=None,
+                        help='spark.driver.memory; with local[*] the driver runs the tasks. Only applies '
+                             'when the JVM is started by this script rather than spark-submit')
+    parser.add_argument('--conf', action='append', default=[], metavar='KEY=VALUE',
+                        help='further Spark setting, may be repeated')
+    parser.add_argument('--metrics-log', default=None, metavar='PATH',
+                        help="append a JSON line per finished read and write stage to PATH, '-' for stdout")
+    parser.add_argument('--prometheus', default=None, metavar='PATH',
+                        help='write the stage totals to PATH in the Prometheus text format')
+    parser.add_argument('--read-mode', choices=READ_MODES, default="permissive",
+                        help='strict fails on the first malformed input record, permissive skips them')
+    parser.add_argument('--quarantine-data', default=None, metavar='PATH',
+                        help='in permissive mode, write malformed records to PATH/song_data/ and PATH/log_data/')
+    parser.add_argument('--broadcast-threshold-mb', type=int, default=None,
+                        help="broadcast the song side of the songplays join when Spark estimates it "
+                             "below this size, Spark's 10 MB if not given; -1 always shuffles both sides")
+    parser.add_argument('--song-storage-level', choices=STORAGE_LEVELS, default="MEMORY_AND_DISK",
+                        help='storage level of the song data shared by the song and log stages')
+    parser.add_argument('--write-mode', choices=WRITE_MODES, default="overwrite",
+                        help='overwrite rebuilds every table; incremental replaces only the (year, month) '
+                             'partitions of the selected log months, merges the users and keeps '
+                             'existing songs and artists')
+    parser.add_argument('--start-date', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                        help='only read the log_data files from this date, all of them if not given')
+    parser.add_argument('--end-date', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                        help='last log_data date to read, --start-date if not given')
+    parser.add_argument('--refresh-songs', action='store_true',
+                        help='in incremental mode, rebuild the songs and artists tables as well')
+    parser.add_argument('--songs-partition-by', choices=sorted(SONGS_PARTITIONINGS), default="year_artist",
+                        help='partition the songs table by year and artist_id, by year only or not at all')
+    parser.add_argument('--repartition-writes', action='store_true',
+                        help='repartition every table by its partition columns before writing, '
+                             'so each partition directory gets one file')
+    parser.add_argument('--target-file-mb', type=int, default=None,
+                        help="aim for parquet files of about this size: unpartitioned tables get as many "
+                             "write tasks as their estimated size needs, partitioned tables a row "
+                             "limit per file from the estimated row size")
+    parser.add_argument('--max-records-per-file', type=int, default=None,
+                        help="split output files above this many rows, 0 for no limit; "
+                             "Spark's setting is kept if not given")
+    args = parser.parse_args()
+    # a static overwrite would rebuild every table from the selected days only and drop all other months
+    if (args.start_date or args.end_date) and args.write_mode != "incremental":
+        parser.error('--start-date and --end-date need --write-mode incremental')
+    # log_data_paths reads all of log_data without a start date, which would rewrite every month
+    if args.end_date and not args.start_date:
+        parser.error('--end-date needs --start-date')
+    return args
 
 def main():
     """
     Description:
         driver program that processes song and log data
         into dimension and fact tables that are written
-        to the S3 output_data path
+        to the output_data path, on S3 or the local filesystem
     """
-    spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://sparkify-mglaros-data-lake/"
-    
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    args = parse_args()
+    input_data = args.input_data.rstrip('/') + '/'
+    output_data = args.output_data.rstrip('/') + '/'
+    s3 = any(path.startswith('s3') for path in [input_data, output_data])
+    if s3:
+        load_aws_config(args.config)
+    spark = create_spark_session(args.master, spark_settings(args), s3)
+
+    # counting the written rows costs a footer read per table, so stages are only measured on request
+    metrics = Instrumentation('spark', args.metrics_log) if args.metrics_log or args.prometheus else None
+
+    layout = {"repartition": args.repartition_writes, "target_file_mb": args.target_file_mb}
+
+    # with dynamic partition overwrite a write only replaces the partitions present in its output
+    incremental = args.write_mode == "incremental"
+    if incremental:
+        spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    log_paths = log_data_paths(spark, input_data, args.start_date, args.end_date, whole_months=incremental)
+    print('reading {} log_data path(s)'.format(len(log_paths)))
+
+    # the cache is keyed by local file paths and modification times
+    local_input = not input_data.startswith('s3')
+    cache = RecordCache(args.cache_dir) if args.cache_dir and local_input else None
+    if args.cache_dir and not local_input:
+        print('the record cache only applies to local input, reading the JSON files')
+
+    # song_data is read once and shared by both stages
+    song_df = read_song_data(spark, input_data, args.song_storage_level, metrics,
+                             args.read_mode, args.quarantine_data, args.song_data, cache)
+    song_tables = [output_data + 'songs/', output_data + 'artists/']
+    if not incremental or args.refresh_songs or not all(path_exists(spark, path) for path in song_tables):
+        with stage(metrics, 'process_song_data'):
+            process_song_data(spark, input_data, output_data, metrics, song_df, layout,
+                              SONGS_PARTITIONINGS[args.songs_partition_by])
+    with stage(metrics, 'process_log_data'):
+        process_log_data(spark, input_data, output_data, metrics, song_df,
+                         args.read_mode, args.quarantine_data, log_paths, incremental, layout, cache)
+    song_df.unpersist()
+
+    if metrics is None:
+        return
+    for line in metrics.summary('stage'):
+        print(line)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus)
+    metrics.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+import os
+import shutil
+import argparse
+import tempfile
+import time
+from etl import get_files, extract_song_file, extract_song_files
+
+
+def replicate_song_data(source, target, num_files):
+    """
+    Fills target with num_files copies of the song files found under
+    source, keeping the song_data/A/B/C/*.json layout of the originals
+    """
+    song_files = get_files(source)
+    for i in range(num_files):
+        original = song_files[i % len(song_files)]
+        subdir = os.path.join(target, os.path.relpath(os.path.dirname(original), source))
+        os.makedirs(subdir, exist_ok=True)
+        shutil.copyfile(original, os.path.join(subdir, '{:07d}_{}'.format(i, os.path.basename(original))))
+
+
+def time_per_file_reader(song_files):
+    """parses every song file with its own pandas DataFrame"""
+    start = time.perf_counter()
+    for filepath in song_files:
+        extract_song_file(filepath)
+    return time.perf_counter() - start
+
+
+def time_batched_reader(song_files, group_size):
+    """parses the song files group_size at a time into one DataFrame each"""
+    start = time.perf_counter()
+    for i in range(0, len(song_files), group_size):
+        extract_song_files(song_files[i:i + group_size])
+    return time.perf_counter() - start
+
+
+def main():
+    """
+    driver program that replicates data/song_data to the requested number
+    of files and compares the per-file and the batched song readers on it
+    """
+    parser = argparse.ArgumentParser(description='Compares the per-file and batched song readers')
+    parser.add_argument('--source', default='data/song_data')
+    parser.add_argument('--num-files', type=int, default=100000)
+    parser.add_argument('--group-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    target = tempfile.mkdtemp(prefix='song_data_')
+    try:
+        replicate_song_data(args.source, target, args.num_files)
+        song_files = get_files(target)
+
+        batched = time_batched_reader(song_files, args.group_size)
+        per_file = time_per_file_reader(song_files)
+
+        print('{} song files'.format(len(song_files)))
+        print('per-file reader: {:.2f}s ({:.0f} files/s)'.format(per_file, len(song_files) / per_file))
+        print('batched reader:  {:.2f}s ({:.0f} files/s), group size {}'.format(
+            batched, len(song_files) / batched, args.group_size))
+        print('speedup: {:.1f}x'.format(per_file / batched))
+    finally:
+        shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    main()
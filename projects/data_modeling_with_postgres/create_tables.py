@@ -1,27 +1,32 @@
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+from psycopg2 import sql
+from sql_queries import (create_table_queries, drop_table_queries, deferred_create_table_queries,
+                         deferred_constraint_queries, songplay_primary_key_select, partitioned_table_queries)
+from partitions import is_partitioned
+from db import connect, get_admin_dsn, get_dsn, get_dbname
 
 
 def create_database():
     """
-    - Creates and connects to the sparkifydb
+    - Creates and connects to the sparkifydb, or the database named by $SPARKIFY_DSN
     - Returns the connection and cursor to sparkifydb
     """
     
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = connect(get_admin_dsn())
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    dbname = sql.Identifier(get_dbname())
+    cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(dbname))
+    cur.execute(sql.SQL("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0").format(dbname))
 
     # close connection to default database
     conn.close()    
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = connect(get_dsn())
     cur = conn.cursor()
     
     return cur, conn
@@ -36,15 +41,36 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=create_table_queries):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list,
+    or `deferred_create_table_queries` for the bulk load schema
     """
-    for query in create_table_queries:
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
+def add_deferred_constraints(cur, conn):
+    """
+    Adds the songplays primary key, the foreign keys and the song lookup
+    indexes left out by the bulk load schema in a single transaction, once
+    the data is loaded. Returns False if the schema already has them
+    """
+    cur.execute(songplay_primary_key_select)
+    if cur.fetchone()[0]:
+        return False
+
+    queries = deferred_constraint_queries
+    if is_partitioned(cur):
+        queries = [partitioned_table_queries.get(query, query) for query in queries]
+
+    for query in queries:
+        cur.execute(query)
+    conn.commit()
+    return True
+
+
 def main():
     """
     - Drops (if exists) and Creates the sparkify database. 
@@ -54,14 +80,28 @@ def main():
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed. With --bulk-load the tables are created
+    without the songplays primary key, foreign keys and lookup indexes,
+    which etl.py adds once the initial load is done. With
+    --partition-songplays songplays is range partitioned by month.
     
     - Finally, closes the connection. 
     """
+    parser = argparse.ArgumentParser(description='Creates the sparkifydb star schema')
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='defer the songplays primary key, foreign keys and indexes until after the first load')
+    parser.add_argument('--partition-songplays', action='store_true',
+                        help='range partition songplays by month of start_time')
+    args = parser.parse_args()
+
+    queries = deferred_create_table_queries if args.bulk_load else create_table_queries
+    if args.partition_songplays:
+        queries = [partitioned_table_queries.get(query, query) for query in queries]
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, queries)
 
     conn.close()
 
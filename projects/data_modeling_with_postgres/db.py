@@ -0,0 +1,111 @@
+import os
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool, sql
+
+# both DSNs can be overridden through the environment
+DEFAULT_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+DEFAULT_ADMIN_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+
+# session settings applied to every loader connection by default; further
+# ones are opted into with etl.py --set, e.g. --set synchronous_commit=off
+LOAD_SETTINGS = {}
+
+_pools = {}
+
+
+def get_dsn(dsn=None):
+    """returns dsn, else $SPARKIFY_DSN, else the local sparkifydb DSN"""
+    return dsn or os.environ.get('SPARKIFY_DSN', DEFAULT_DSN)
+
+
+def get_admin_dsn(dsn=None):
+    """returns dsn, else $SPARKIFY_ADMIN_DSN, else the local studentdb DSN"""
+    return dsn or os.environ.get('SPARKIFY_ADMIN_DSN', DEFAULT_ADMIN_DSN)
+
+
+def get_dbname(dsn=None):
+    """returns the database name the DSN connects to"""
+    return psycopg2.extensions.parse_dsn(get_dsn(dsn)).get('dbname', 'sparkifydb')
+
+
+def parse_settings(pairs):
+    """turns NAME=VALUE strings, e.g. from the command line, into a settings dict"""
+    settings = {}
+    for pair in pairs or []:
+        name, _, value = pair.partition('=')
+        settings[name.strip()] = value.strip()
+    return settings
+
+
+def apply_settings(conn, settings):
+    """
+    Applies session settings such as synchronous_commit, work_mem or
+    statement_timeout to conn with SET and commits them
+    """
+    if not settings:
+        return
+    with conn.cursor() as cur:
+        for name, value in settings.items():
+            cur.execute(sql.SQL("SET {} = %s").format(sql.Identifier(name)), (str(value),))
+    conn.commit()
+
+
+def connect(dsn=None, settings=None):
+    """opens a single connection to dsn with the given session settings"""
+    conn = psycopg2.connect(get_dsn(dsn))
+    apply_settings(conn, settings)
+    return conn
+
+
+class TunedConnectionPool(pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that applies the given session settings to
+    every connection it opens, so pooled connections come back tuned
+    """
+
+    def __init__(self, minconn, maxconn, dsn, settings=None):
+        # the parent constructor already opens minconn connections
+        self.settings = dict(settings or {})
+        super().__init__(minconn, maxconn, dsn)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        apply_settings(conn, self.settings)
+        return conn
+
+
+def get_pool(dsn=None, settings=None, minconn=1, maxconn=8):
+    """
+    Returns the process-wide pool for dsn, creating it on first use with
+    the given settings and size. Later calls for the same dsn return the
+    existing pool and ignore settings
+    """
+    dsn = get_dsn(dsn)
+    if dsn not in _pools or _pools[dsn].closed:
+        _pools[dsn] = TunedConnectionPool(minconn, maxconn, dsn, settings)
+    return _pools[dsn]
+
+
+@contextmanager
+def pooled_connection(dsn=None, settings=None):
+    """
+    Borrows a connection from the pool for dsn and returns it afterwards.
+    Uncommitted work is rolled back before the connection goes back
+    """
+    connection_pool = get_pool(dsn, settings)
+    conn = connection_pool.getconn()
+    try:
+        yield conn
+    finally:
+        if not conn.closed:
+            conn.rollback()
+        connection_pool.putconn(conn)
+
+
+def close_pools():
+    """closes every connection of every pool opened by this process"""
+    for connection_pool in _pools.values():
+        if not connection_pool.closed:
+            connection_pool.closeall()
+    _pools.clear()
@@ -1,58 +1,186 @@
 import os
+import io
+import sys
+import json
 import glob
-import psycopg2
+import argparse
+import multiprocessing
+import time
+from collections import deque
+from functools import partial
 import pandas as pd
+import sql_queries
 from sql_queries import *
+from db import get_pool, close_pools, parse_settings, LOAD_SETTINGS
+# modules shared by the projects, such as instrumentation.py and record_cache.py, live in projects/
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Instrumentation, instrumented_cursor
+from create_tables import add_deferred_constraints
+from partitions import SongplayPartitions, is_partitioned
+from song_index import SongLookupIndex
+from time_dimension import time_table_rows, SeenTimestamps
+from user_dimension import latest_user_rows, SentUserStates
+from record_cache import RecordCache, RECORD_FIELDS
+from compact_song_data import MANIFEST_NAME, file_md5
 
+# fields of a log_data event needed by the star schema
+LOG_EVENT_COLUMNS = ["ts", "userId", "firstName", "lastName", "gender", "level", "song", "artist",
+                     "length", "sessionId", "location", "userAgent"]
 
-def process_song_file(cur, filepath):
+# fields of a song_data record, in file order
+SONG_FILE_COLUMNS = [name for name, _ in RECORD_FIELDS['song']]
+
+# chunks of parsed files queued per pool worker ahead of the database writer
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+
+def extract_song_file(filepath):
     """
-    This function populates the songs and artists dimension tables after 
-    selecting specific fields from each of the log files found under data/song_data
+    Reads a song file and returns the artist and song records selected from
+    it. This step needs no database cursor, so it can run in a pool worker
     """
     # open song file
     df = pd.read_json(filepath, lines=True)
     artist_select_cols = ["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]
     song_select_cols = ["song_id", "title", "artist_id", "year", "duration"]
-    
-    # insert artist record
+
     artist_data = list(df[artist_select_cols].values[0])
+    song_data = list(df[song_select_cols].values[0])
+    return artist_data, song_data
+
+
+def load_song_data(cur, data, song_index=None):
+    """
+    Inserts the artist and song records returned by extract_song_file and
+    returns the number of source records loaded. When a song_index is
+    given the inserted song is registered with it
+    """
+    artist_data, song_data = data
+
+    # insert artist record
     cur.execute(artist_table_insert, artist_data)
     
     # insert song record
-    song_data = list(df[song_select_cols].values[0])
     cur.execute(song_table_insert, song_data)
 
+    if song_index is not None:
+        song_id, title, artist_id, year, duration = song_data
+        song_index.add(title, artist_data[1], duration, song_id, artist_id)
+
+    return 1
 
-def process_log_file(cur, filepath):
+
+def process_song_file(cur, filepath, song_index=None):
     """
-    This function populates the time and users dimension tables
-    and the songplays fact table from each of the files under data/log_data
+    This function populates the songs and artists dimension tables after 
+    selecting specific fields from each of the log files found under data/song_data.
+    A compacted shard is loaded one record at a time
     """
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    if not is_song_shard(filepath):
+        return load_song_data(cur, extract_song_file(filepath), song_index)
 
-    # filter by NextSong action
-    df = df[df['page'] == 'NextSong']
+    df = extract_song_files([filepath])
+    artist_rows = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
+    song_rows = df[["song_id", "title", "artist_id", "year", "duration"]]
+    for data in zip(artist_rows.values.tolist(), song_rows.values.tolist()):
+        load_song_data(cur, data, song_index)
+    return len(df)
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records
-    time_data = (t, t.dt.hour, t.dt.day, t.dt.weekofyear, t.dt.month, t.dt.year, t.dt.weekday)
-    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-   
-    #initialize the data to pass to the pd.DataFrame() constructor 
-    #will be of the form {'start_time': pd.Series, 'hour': pd.Series, ...}
-    data_dict = dict(list(zip(column_labels, time_data)))
-    time_df = pd.DataFrame(data_dict)
 
+def is_song_shard(filepath):
+    """tells whether filepath is a shard written by ../compact_song_data.py rather than a song file"""
+    return filepath.endswith(('.ndjson', '.parquet'))
+
+
+def extract_song_files(filepaths, cache=None):
+    """
+    Reads many song files into a single DataFrame, parsing each line with
+    json.loads instead of building a pandas DataFrame per file. Compacted
+    NDJSON shards are read the same way and parquet shards with pandas.
+    With a RecordCache the records of compacted shards are taken from or
+    added to it; song files of one record each are read without it, since
+    a cache entry per song costs more to open than its JSON to parse. This
+    step needs no database cursor, so it can run in a pool worker
+    """
+    if cache is not None and all(is_song_shard(filepath) for filepath in filepaths):
+        return cache.records('song', filepaths)[SONG_FILE_COLUMNS]
+
+    records, frames = [], []
+    for filepath in filepaths:
+        if filepath.endswith('.parquet'):
+            frames.append(pd.read_parquet(filepath, columns=SONG_FILE_COLUMNS))
+            continue
+        with open(filepath) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+
+    if records or not frames:
+        frames.append(pd.DataFrame.from_records(records, columns=SONG_FILE_COLUMNS))
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def extract_song_shard(filepath, cache=None):
+    """reads the records of one compacted shard, see extract_song_files"""
+    return extract_song_files([filepath], cache)
+
+
+def load_song_batch(cur, df, song_index=None):
+    """
+    Loads a DataFrame returned by extract_song_files with one COPY per
+    staging table and one set-based merge into artists and songs each.
+    Returns the number of song records loaded
+    """
+    cur.execute(song_staging_truncate)
+
+    # the ordinal lets the merges keep the first record of a duplicated artist or song
+    ordinal = range(len(df))
+    artist_df = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
+    artist_df.columns = ['artist_id', 'name', 'location', 'latitude', 'longitude']
+    copy_dataframe(cur, artist_df.assign(ordinal=ordinal), 'artist_staging')
+
+    song_df = df[["song_id", "title", "artist_id", "year", "duration"]]
+    copy_dataframe(cur, song_df.assign(ordinal=ordinal), 'song_staging')
+
+    cur.execute(artist_table_merge)
+    cur.execute(song_table_merge)
+
+    if song_index is not None:
+        for title, artist_name, duration, song_id, artist_id in zip(
+                df['title'], df['artist_name'], df['duration'], df['song_id'], df['artist_id']):
+            song_index.add(title, artist_name, duration, song_id, artist_id)
+
+    return len(df)
+
+
+def copy_dataframe(cur, df, table):
+    """
+    Streams the rows of df into table with a single COPY FROM STDIN by
+    serializing them into an in-memory CSV buffer. The DataFrame columns
+    must match the column names of the target table. Missing values are
+    written as \\N, so empty strings stay empty strings as in row mode
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
+    cur.copy_expert(staging_copy.format(table=table, columns=', '.join(df.columns)), buffer)
+
+
+def create_staging_tables(cur):
+    """
+    Creates the session-scoped temp tables used by the bulk loaders
+    """
+    for query in staging_table_queries:
+        cur.execute(query)
+
+
+def insert_log_rows(cur, df, time_df, user_df, song_index=None):
+    """
+    Row-by-row fallback loader: issues one INSERT per time, user and
+    songplay record and resolves song_id/artist_id with the song_index,
+    or with a song_select query per event when no index is given
+    """
     for i, row in time_df.iterrows():
         cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
-
     # insert user records
     for i, row in user_df.iterrows():
         cur.execute(user_table_insert, row)
@@ -61,8 +189,11 @@ def process_log_file(cur, filepath):
     for index, row in df.iterrows():
         
         # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+        if song_index is not None:
+            results = song_index.lookup(row.song, row.artist, row.length)
+        else:
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
         
         if results:
             songid, artistid = results
@@ -74,39 +205,563 @@ def process_log_file(cur, filepath):
         cur.execute(songplay_table_insert, songplay_data)
 
 
-def process_data(cur, conn, filepath, func):
+def copy_log_rows(cur, df, time_df, user_df, song_index=None):
     """
-    This function locates all of the files found under filepath, which can
-    be either data/song_data or data/log_data and calls process_song_data or process_log_data
-    respectively for each of the files found
+    Bulk loader: COPYs the time, user and songplay rows of a batch into the
+    staging temp tables and merges each into the star schema with a single
+    INSERT ... SELECT ... ON CONFLICT statement. song_id/artist_id are
+    resolved with the song_index if given, otherwise by the merge join
+    """
+    cur.execute(staging_truncate)
+
+    copy_dataframe(cur, time_df, 'time_staging')
+
+    user_staging_df = user_df.assign(ts=df.loc[user_df.index, 'ts'].values)
+    user_staging_df.columns = ['user_id', 'first_name', 'last_name', 'gender', 'level', 'ts']
+    copy_dataframe(cur, user_staging_df, 'user_staging')
+
+    if song_index is not None:
+        matches = song_index.resolve(df)
+    else:
+        matches = pd.DataFrame({'song_id': None, 'artist_id': None}, index=df.index)
+
+    songplay_staging_df = pd.DataFrame({
+        'start_time': pd.to_datetime(df['ts'], unit='ms'),
+        'user_id': df['userId'],
+        'level': df['level'],
+        'song_id': matches['song_id'],
+        'artist_id': matches['artist_id'],
+        'song': df['song'],
+        'artist': df['artist'],
+        'length': df['length'],
+        'session_id': df['sessionId'],
+        'location': df['location'],
+        'user_agent': df['userAgent']
+    })
+    copy_dataframe(cur, songplay_staging_df, 'songplay_staging')
+
+    cur.execute(time_table_merge)
+    cur.execute(user_table_merge)
+    cur.execute(songplay_table_merge if song_index is None else songplay_table_resolved_merge)
+
+
+def extract_log_file(filepath, cache=None):
+    """
+    Reads a log file, keeps the NextSong events and derives the time and
+    user records from them. Returns the (events, time, users) DataFrames.
+    With a RecordCache the parsed events are taken from or added to it.
+    This step needs no database cursor, so it can run in a pool worker
+    """
+    # open log file
+    df = cache.records('log', [filepath]) if cache is not None else pd.read_json(filepath, lines=True)
+
+    # filter by NextSong action
+    df = df[df['page'] == 'NextSong']
+
+    return transform_log_events(df)
+
+
+def transform_log_events(df):
+    """
+    Derives the time and user records from a DataFrame of NextSong events
+    and returns the (events, time, users) DataFrames
+    """
+    # derive one time record per distinct timestamp from the epoch ms column
+    time_df = time_table_rows(df['ts'].values)
+
+    # load user table, keeping only the latest event of each user
+    user_df = latest_user_rows(df)
+
+    return df, time_df, user_df
+
+
+def iter_log_chunks(filepath, chunk_rows=10000):
+    """
+    Streams a log file line by line and yields DataFrames of at most
+    chunk_rows NextSong events, projected to LOG_EVENT_COLUMNS. Lines of
+    other pages are dropped before they are parsed, so memory use is
+    bounded by chunk_rows regardless of the file size
+    """
+    records = []
+    with open(filepath) as f:
+        for line in f:
+            if '"NextSong"' not in line:
+                continue
+            event = json.loads(line)
+            if event.get('page') != 'NextSong':
+                continue
+            records.append([event.get(column) for column in LOG_EVENT_COLUMNS])
+            if len(records) >= chunk_rows:
+                yield pd.DataFrame(records, columns=LOG_EVENT_COLUMNS)
+                records = []
+
+    if records:
+        yield pd.DataFrame(records, columns=LOG_EVENT_COLUMNS)
+
+
+def stream_log_file(cur, filepath, chunk_rows=10000, **load_options):
+    """
+    Populates the time, users and songplays tables from a log file one
+    chunk of chunk_rows NextSong events at a time. load_options are passed
+    on to load_log_data. Returns the number of NextSong events loaded
+    """
+    loaded = 0
+    for chunk in iter_log_chunks(filepath, chunk_rows):
+        loaded += load_log_data(cur, transform_log_events(chunk), **load_options)
+    return loaded
+
+
+def load_log_data(cur, data, load_mode='bulk', song_index=None, seen_times=None, sent_users=None,
+                  partitions=None):
+    """
+    Loads the DataFrames returned by extract_log_file. load_mode is either
+    'bulk' (COPY into staging tables followed by a set-based merge) or
+    'row' (one INSERT per record). song_index is an optional
+    SongLookupIndex used to resolve song_id and artist_id. seen_times and
+    sent_users are an optional SeenTimestamps and SentUserStates that drop
+    time and user records already sent during the run. partitions is the
+    SongplayPartitions of a partitioned songplays table, used to create
+    the monthly partitions the events need. Returns the number of NextSong
+    events loaded
     """
-    # get all files matching extension from directory
+    df, time_df, user_df = data
+
+    if seen_times is not None:
+        time_df = seen_times.filter(time_df)
+    if sent_users is not None:
+        user_df = sent_users.filter(user_df, len(df))
+    if partitions is not None:
+        partitions.ensure(cur, df['ts'].values)
+
+    if load_mode == 'bulk':
+        copy_log_rows(cur, df, time_df, user_df, song_index)
+    else:
+        insert_log_rows(cur, df, time_df, user_df, song_index)
+
+    return len(df)
+
+
+def process_log_file(cur, filepath, load_mode='row', song_index=None, partitions=None):
+    """
+    This function populates the time and users dimension tables
+    and the songplays fact table from each of the files under data/log_data.
+    The bulk load mode needs the staging tables of create_staging_tables.
+    A partitioned songplays table gets the monthly partitions of the file,
+    through partitions or a SongplayPartitions made for this call
+    """
+    if partitions is None and is_partitioned(cur):
+        partitions = SongplayPartitions()
+    return load_log_data(cur, extract_log_file(filepath), load_mode, song_index, partitions=partitions)
+
+
+def get_files(filepath):
+    """
+    Returns the absolute paths of all JSON files found under filepath in
+    sorted order, so every run visits the files in the same sequence.
+    A directory written by ../compact_song_data.py returns the shards
+    listed in its manifest instead
+    """
+    manifest_path = os.path.join(filepath, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return [os.path.abspath(os.path.join(filepath, shard['path'])) for shard in manifest['shards']]
+
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    return sorted(all_files)
+
+
+def select_changed_files(cur, conn, filepath, all_files, full_refresh=False):
+    """
+    Compares all_files against the file_manifest table and returns a dict
+    mapping each file that is new or changed to its (size, mtime, content
+    hash) fingerprint, in file order. Files whose size and mtime match the
+    manifest are skipped without being read; files that were only touched
+    have their manifest entry refreshed. With full_refresh every file is
+    returned
+    """
+    cur.execute(file_manifest_select, (os.path.abspath(filepath) + '%',))
+    manifest = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in cur.fetchall()}
+
+    changed = {}
+    for datafile in all_files:
+        stat = os.stat(datafile)
+        known = manifest.get(datafile)
+        if not full_refresh and known and known[:2] == (stat.st_size, stat.st_mtime):
+            continue
+
+        fingerprint = (stat.st_size, stat.st_mtime, file_md5(datafile))
+        if not full_refresh and known and known[2] == fingerprint[2]:
+            cur.execute(file_manifest_upsert, (datafile,) + fingerprint)
+            continue
+        changed[datafile] = fingerprint
+
+    conn.commit()
+    return changed
+
+
+def guarded_extract(extract, source):
+    """
+    Calls extract(source) and returns the raised exception instead of
+    propagating it, so one unreadable file does not abort a pool of workers
+    """
+    try:
+        return extract(source)
+    except Exception as e:
+        return e
+
+
+def guarded_extract_chunk(extract, sources):
+    """calls guarded_extract on each of sources, so a pool task parses a chunk of them"""
+    return [guarded_extract(extract, source) for source in sources]
+
+
+def bounded_imap(pool, extract, sources, chunksize, in_flight):
+    """
+    Yields guarded_extract of each of sources in order, parsed by pool in
+    chunks of chunksize with at most in_flight chunks submitted and not yet
+    taken. Unlike Pool.imap, which submits every task at once, the parsed
+    results cannot pile up in memory while the database writer falls behind
+    """
+    pending = deque()
+    for i in range(0, len(sources), chunksize):
+        if len(pending) >= in_flight:
+            yield from pending.popleft().get()
+        pending.append(pool.apply_async(guarded_extract_chunk, (extract, sources[i:i + chunksize])))
+    while pending:
+        yield from pending.popleft().get()
+
+
+def retry_batch(conn, load, batch, on_rollback=None, metrics=None):
+    """
+    Reloads a failed batch of (files, item) pairs committing one pair at a
+    time, to isolate the offending input. Returns the paths that still fail
+    """
+    failed = []
+    for unit, item in batch:
+        try:
+            if isinstance(item, Exception):
+                raise item
+            loaded = load(unit, item)
+            conn.commit()
+            if metrics is not None:
+                metrics.count(rows=loaded or 0)
+        except Exception as e:
+            conn.rollback()
+            if on_rollback is not None:
+                on_rollback()
+            print('failed to load {}: {}'.format(', '.join(unit), e))
+            failed += unit
+    return failed
+
+
+def process_data(cur, conn, filepath, func, extract=None, workers=1, chunksize=16,
+                 batch_files=1, batch_rows=None, batch_seconds=None, full_refresh=False,
+                 group_size=1, on_rollback=None, metrics=None):
+    """
+    This function locates all of the files found under filepath, which can
+    be either data/song_data or data/log_data and calls process_song_data or process_log_data
+    respectively for each of the files found.
+
+    If extract is given, each file is first parsed with extract(filepath)
+    and func is called with the parsed data instead of the path. With
+    workers > 1 the parsing runs in a process pool of that size, handing
+    out chunksize files at a time, while this process remains the single
+    writer and loads the results in file order, so the output is the same
+    as a serial run. With group_size > 1, extract (or func, without an
+    extract step) receives lists of up to group_size paths instead of a
+    single path.
+
+    Files are committed in batches: a batch is committed once it holds
+    batch_files files, once func has reported batch_rows loaded records or
+    once it has been open for batch_seconds, whichever comes first. If a
+    batch fails it is rolled back and retried file by file. Returns the
+    paths of the files that could not be loaded.
+
+    Only files that are new or changed according to the file_manifest
+    table are processed, unless full_refresh is set. Each loaded file is
+    recorded in the manifest in the same transaction as its data.
+
+    on_rollback is called without arguments after every rollback, so
+    in-memory state derived from uncommitted data can be discarded.
+
+    The run is reported to metrics, an Instrumentation, as a stage named
+    after the directory, with one batch stage per commit holding its
+    files, rows, bytes read and retries
+    """
+    if metrics is None:
+        metrics = Instrumentation('postgres')
+
+    with metrics.stage(os.path.basename(os.path.normpath(filepath))):
+        # get all files matching extension from directory
+        all_files = get_files(filepath)
+        print('{} files found in {}'.format(len(all_files), filepath))
+
+        # keep only the files not yet recorded in the manifest
+        fingerprints = select_changed_files(cur, conn, filepath, all_files, full_refresh)
+        all_files = list(fingerprints)
+
+        # get total number of files to process
+        num_files = len(all_files)
+        print('{} files are new or changed'.format(num_files))
+
+        # group the files into the units of work handed to extract and func
+        units = [all_files[i:i + group_size] for i in range(0, num_files, group_size)]
+
+        def source(unit):
+            """the argument extract, or func without an extract step, receives for a unit"""
+            return unit if group_size > 1 else unit[0]
+
+        def load(unit, item):
+            """loads one unit of work and records its files in the manifest"""
+            loaded = func(cur, item)
+            for datafile in unit:
+                cur.execute(file_manifest_upsert, (datafile,) + fingerprints[datafile])
+            return loaded
+
+        def batch_bytes(pairs):
+            """size on disk of the files of a batch"""
+            return sum(fingerprints[datafile][0] for unit, item in pairs for datafile in unit)
+
+        def split(pairs):
+            """breaks grouped (files, item) pairs into single-file pairs for a file by file retry"""
+            if group_size == 1:
+                return pairs
+            singles = []
+            for unit, item in pairs:
+                for datafile in unit:
+                    single = [datafile]
+                    singles.append((single, single if extract is None else guarded_extract(extract, single)))
+            return singles
+
+        if extract is None:
+            items = map(source, units)
+        elif workers > 1:
+            pool = multiprocessing.Pool(workers)
+            items = bounded_imap(pool, extract, [source(unit) for unit in units], chunksize,
+                                 workers * CHUNKS_IN_FLIGHT_PER_WORKER)
+        else:
+            items = (guarded_extract(extract, source(unit)) for unit in units)
+
+        failed = []
+        done = 0
+        batch, rows, batch_start = [], 0, time.perf_counter()
+
+        # iterate over files and process
+        try:
+            for unit, item in zip(units, items):
+                done += len(unit)
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+                # a group that failed to parse is reparsed file by file
+                pieces = split([(unit, item)]) if isinstance(item, Exception) else [(unit, item)]
+                for unit, item in pieces:
+                    if isinstance(item, Exception):
+                        print('failed to read {}: {}'.format(', '.join(unit), item))
+                        failed += unit
+                        continue
+
+                    batch.append((unit, item))
+                    try:
+                        rows += load(unit, item) or 0
+                    except Exception as e:
+                        conn.rollback()
+                        if on_rollback is not None:
+                            on_rollback()
+                        batch_size = sum(len(unit) for unit, item in batch)
+                        print('batch of {} files failed ({}), retrying file by file'.format(batch_size, e))
+                        failed += retry_batch(conn, load, split(batch), on_rollback, metrics)
+                        print('{}/{} files processed. batch of {} files retried in {:.3f}s'.format(
+                            done, num_files, batch_size, time.perf_counter() - batch_start))
+                        metrics.record('batch', time.perf_counter() - batch_start, bytes=batch_bytes(batch),
+                                       retries=1, files=batch_size)
+                        batch, rows, batch_start = [], 0, time.perf_counter()
+
+                # nothing is left to commit after a retried batch or unreadable files
+                if not batch:
+                    continue
+                batch_size = sum(len(unit) for unit, item in batch)
+                elapsed = time.perf_counter() - batch_start
+                if (done < num_files and batch_size < batch_files
+                        and (batch_rows is None or rows < batch_rows)
+                        and (batch_seconds is None or elapsed < batch_seconds)):
+                    continue
+
+                retries = 0
+                try:
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    if on_rollback is not None:
+                        on_rollback()
+                    print('commit of {} files failed ({}), retrying file by file'.format(batch_size, e))
+                    failed += retry_batch(conn, load, split(batch), on_rollback, metrics)
+                    retries = 1
+                print('{}/{} files processed. batch of {} files, {} rows committed in {:.3f}s'.format(
+                    done, num_files, batch_size, rows, time.perf_counter() - batch_start))
+                # rows of a retried batch were counted file by file by retry_batch
+                metrics.record('batch', time.perf_counter() - batch_start, rows=0 if retries else rows,
+                               bytes=batch_bytes(batch), retries=retries, files=batch_size)
+                batch, rows, batch_start = [], 0, time.perf_counter()
+        finally:
+            if extract is not None and workers > 1:
+                pool.terminate()
+
+        if failed:
+            print('{} of {} files in {} failed to load'.format(len(failed), num_files, filepath))
+        return failed
+
+
+def parse_args():
+    """parses the command line options of the ETL pipeline"""
+    parser = argparse.ArgumentParser(description='Loads song_data and log_data into sparkifydb')
+    parser.add_argument('--dsn', default=None,
+                        help='libpq connection string, defaults to $SPARKIFY_DSN or the local sparkifydb')
+    parser.add_argument('--data-dir', default='data',
+                        help='directory holding song_data/ and log_data/, e.g. the output of ../generate_data.py')
+    parser.add_argument('--song-data', default=None,
+                        help='song_data directory or shards written by ../compact_song_data.py, '
+                             'defaults to DATA_DIR/song_data')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='session setting for the loader connection, e.g. work_mem=256MB; repeatable')
+    parser.add_argument('--load-mode', choices=['bulk', 'row'], default='bulk',
+                        help="'bulk' COPYs each batch into staging tables and merges set-based, "
+                             "'row' inserts one record at a time")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing files in parallel; 1 parses serially')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='number of files handed to a worker at a time')
+    parser.add_argument('--batch-files', type=int, default=100,
+                        help='commit after this many files')
+    parser.add_argument('--batch-rows', type=int, default=None,
+                        help='commit once this many records were loaded in the current batch')
+    parser.add_argument('--batch-seconds', type=float, default=None,
+                        help='commit once the current batch has been open this many seconds')
+    parser.add_argument('--song-group-size', type=int, default=1000,
+                        help='number of song files read into one DataFrame and merged set-based; '
+                             '1 loads each song file on its own')
+    parser.add_argument('--stream-chunk-rows', type=int, default=None,
+                        help='stream each log file in chunks of this many NextSong events '
+                             'instead of reading it into memory at once')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='reprocess every file, ignoring the file manifest')
+    parser.add_argument('--cache-dir', default=None, metavar='PATH',
+                        help='keep the parsed log records and compacted song shards as parquet under PATH '
+                             'and read them from there on later runs while their source files are unchanged')
+    parser.add_argument('--cache-max-mb', type=int, default=1024,
+                        help='evict the least recently used cache entries beyond this size at the end of the run')
+    parser.add_argument('--metrics-log', default=None, metavar='PATH',
+                        help="append a JSON line per finished stage to PATH, '-' for stdout")
+    parser.add_argument('--metrics-log-statements', action='store_true',
+                        help='also log a JSON line per executed SQL statement')
+    parser.add_argument('--prometheus', default=None, metavar='PATH',
+                        help='write the stage and statement totals to PATH in the Prometheus text format')
+    return parser.parse_args()
 
 
 def main():
     """driver function for the entire ETL pipeline"""
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
+    args = parse_args()
+
+    run_start = time.perf_counter()
+
+    settings = dict(LOAD_SETTINGS, **parse_settings(args.set))
+    connection_pool = get_pool(args.dsn, settings)
+    conn = connection_pool.getconn()
+
+    # time every stage and statement, naming statements after sql_queries.py
+    metrics = Instrumentation('postgres', args.metrics_log, args.metrics_log_statements)
+    metrics.name_statements(sql_queries)
+    cur = instrumented_cursor(conn, metrics)
+
+    create_staging_tables(cur)
+    conn.commit()
+
+    # build the song lookup index once and keep it in sync while loading songs
+    song_index = SongLookupIndex()
+    with metrics.stage('song_index'):
+        song_index.build(cur)
+
+    # drop time and user records already sent during this run before they reach the database
+    seen_times = SeenTimestamps()
+    sent_users = SentUserStates()
+
+    # a partitioned songplays table gets its monthly partitions on demand
+    partitions = SongplayPartitions() if is_partitioned(cur) else None
+
+    def reset_sent_records():
+        """rolled back time and user records and partitions have to be sent again"""
+        seen_times.reset()
+        sent_users.reset()
+        if partitions is not None:
+            partitions.reset()
+
+    def reset_song_index():
+        """songs of a rolled back batch must not be matched by the songplays"""
+        song_index.rebuild(cur)
+
+    options = dict(batch_files=args.batch_files, batch_rows=args.batch_rows, batch_seconds=args.batch_seconds,
+                    full_refresh=args.full_refresh, metrics=metrics)
+
+    # parsed records of log files and song shards are cached by source file; one-record
+    # song files and the streamed log reader bypass the cache
+    cache = RecordCache(args.cache_dir, args.cache_max_mb * 1024 * 1024) if args.cache_dir else None
+
+    song_path = args.song_data or os.path.join(args.data_dir, 'song_data')
+    log_path = os.path.join(args.data_dir, 'log_data')
+    if os.path.exists(os.path.join(song_path, MANIFEST_NAME)):
+        # a shard already holds many songs, so each one is read and merged as a batch
+        process_data(cur, conn, filepath=song_path, func=partial(load_song_batch, song_index=song_index),
+                     extract=partial(extract_song_shard, cache=cache), workers=args.workers, chunksize=1,
+                     on_rollback=reset_song_index, **options)
+    elif args.song_group_size > 1:
+        process_data(cur, conn, filepath=song_path, func=partial(load_song_batch, song_index=song_index),
+                     extract=extract_song_files, workers=args.workers, chunksize=1,
+                     group_size=args.song_group_size, on_rollback=reset_song_index, **options)
+    else:
+        process_data(cur, conn, filepath=song_path, func=partial(load_song_data, song_index=song_index),
+                     extract=extract_song_file, workers=args.workers,
+                     chunksize=args.chunksize, on_rollback=reset_song_index, **options)
+    log_options = dict(load_mode=args.load_mode, song_index=song_index, seen_times=seen_times, sent_users=sent_users,
+                       partitions=partitions)
+    if args.stream_chunk_rows:
+        process_data(cur, conn, filepath=log_path,
+                     func=partial(stream_log_file, chunk_rows=args.stream_chunk_rows, **log_options),
+                     on_rollback=reset_sent_records, **options)
+    else:
+        process_data(cur, conn, filepath=log_path, func=partial(load_log_data, **log_options),
+                     extract=partial(extract_log_file, cache=cache), workers=args.workers, chunksize=args.chunksize,
+                     on_rollback=reset_sent_records, **options)
+
+    print('data loaded in {:.3f}s'.format(time.perf_counter() - run_start))
+
+    # a schema created with create_tables.py --bulk-load gets its constraints now
+    constraints_start = time.perf_counter()
+    with metrics.stage('constraints'):
+        built = add_deferred_constraints(cur, conn)
+    if built:
+        print('deferred constraints and indexes built in {:.3f}s'.format(time.perf_counter() - constraints_start))
+
+    print(song_index.summary())
+    print(seen_times.summary())
+    print(sent_users.summary())
+    if cache is not None:
+        cache.evict()
+        print(cache.summary())
+    print('slowest statements:')
+    for line in metrics.summary():
+        print(line)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus)
+    metrics.close()
 
-    conn.close()
+    connection_pool.putconn(conn)
+    close_pools()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import argparse
+from datetime import date
+import numpy as np
+from psycopg2 import sql
+from sql_queries import (songplay_partition_create, songplay_partition_drop,
+                         songplay_partitioned_select, songplay_partitions_select)
+from db import connect
+
+
+def partition_name(year, month):
+    """returns the name of the songplays partition holding year-month"""
+    return 'songplays_y{:04d}m{:02d}'.format(year, month)
+
+
+def month_bounds(year, month):
+    """returns the first day of year-month and the first day of the month after it"""
+    return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned(cur):
+    """tells whether songplays was created as a partitioned table"""
+    cur.execute(songplay_partitioned_select)
+    return bool(cur.fetchone()[0])
+
+
+class SongplayPartitions:
+    """
+    Monthly songplays partitions known to exist during a run. ensure()
+    creates the partitions a batch of events needs before its songplays are
+    inserted. Call reset() after a rollback, since rolled back partitions
+    have to be created again
+    """
+
+    def __init__(self):
+        self.months = set()
+        self.created = 0
+
+    def ensure(self, cur, ts):
+        """creates any missing partition for an array of epoch ms timestamps"""
+        months = np.unique(np.asarray(ts, dtype=np.int64).astype('datetime64[ms]').astype('datetime64[M]'))
+        for month in months.tolist():
+            key = (month.year, month.month)
+            if key in self.months:
+                continue
+            start, end = month_bounds(*key)
+            cur.execute(sql.SQL(songplay_partition_create).format(partition=sql.Identifier(partition_name(*key))),
+                        (start, end))
+            self.months.add(key)
+            self.created += 1
+
+    def reset(self):
+        """forgets every known partition, e.g. after a rolled back batch"""
+        self.months.clear()
+
+
+def drop_partitions_before(cur, conn, year, month):
+    """
+    Drops every monthly songplays partition older than year-month. Dropping
+    a partition removes a whole month without scanning or vacuuming the
+    rest of the table. Returns the names of the dropped partitions
+    """
+    cur.execute(songplay_partitions_select)
+    cutoff = partition_name(year, month)
+    dropped = [name for name, in cur.fetchall() if name.startswith('songplays_y') and name < cutoff]
+    for name in dropped:
+        cur.execute(sql.SQL(songplay_partition_drop).format(partition=sql.Identifier(name)))
+    conn.commit()
+    return dropped
+
+
+def main():
+    """driver program that applies a retention cutoff to the songplays partitions"""
+    parser = argparse.ArgumentParser(description='Drops songplays partitions older than a month')
+    parser.add_argument('--drop-before', required=True, metavar='YYYY-MM',
+                        help='first month to keep')
+    args = parser.parse_args()
+    year, month = (int(part) for part in args.drop_before.split('-'))
+
+    conn = connect()
+    cur = conn.cursor()
+    for name in drop_partitions_before(cur, conn, year, month):
+        print('dropped {}'.format(name))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import time
+import pandas as pd
+from sql_queries import song_lookup_select
+
+# songs.duration is NUMERIC while the log lengths are parsed as floats,
+# so both sides are rounded to this many decimals before matching
+DURATION_PRECISION = 5
+
+
+class SongLookupIndex:
+    """
+    In-memory (title, artist name, duration) -> (song_id, artist_id) index.
+    It is built once per run from the songs and artists tables and kept in
+    sync by process_song_file, so songplay resolution becomes a dict probe
+    instead of one song_select round trip per event
+    """
+
+    def __init__(self, precision=DURATION_PRECISION):
+        self.precision = precision
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.build_seconds = 0.0
+
+    def key(self, title, artist_name, duration):
+        """returns the normalized lookup key for a song"""
+        if duration is None or pd.isna(duration):
+            return (title, artist_name, None)
+        return (title, artist_name, round(float(duration), self.precision))
+
+    def build(self, cur):
+        """loads every song joined with its artist from the database"""
+        start = time.perf_counter()
+        cur.execute(song_lookup_select)
+        for title, artist_name, duration, song_id, artist_id in cur.fetchall():
+            self.add(title, artist_name, duration, song_id, artist_id)
+        self.build_seconds = time.perf_counter() - start
+
+    def rebuild(self, cur):
+        """
+        drops every entry and loads the committed songs again; call it after
+        a rollback, since songs added by rolled back loads are not in the database
+        """
+        self.entries.clear()
+        self.build(cur)
+
+    def add(self, title, artist_name, duration, song_id, artist_id):
+        """registers a song; the first song inserted for a key wins"""
+        self.entries.setdefault(self.key(title, artist_name, duration), (song_id, artist_id))
+
+    def lookup(self, title, artist_name, duration):
+        """returns (song_id, artist_id) for a single event or (None, None)"""
+        result = self.entries.get(self.key(title, artist_name, duration))
+        if result is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return result
+
+    def resolve(self, df):
+        """
+        Resolves the song, artist and length columns of an event DataFrame
+        and returns a DataFrame of song_id and artist_id aligned to df.index
+        """
+        matches = [self.lookup(title, artist_name, duration)
+                   for title, artist_name, duration in zip(df['song'], df['artist'], df['length'])]
+        return pd.DataFrame(matches, columns=['song_id', 'artist_id'], index=df.index)
+
+    def summary(self):
+        """one line report of the index size, build time and hit rate"""
+        return 'song lookup index: {} entries built in {:.3f}s, {} hits, {} misses'.format(
+            len(self.entries), self.build_seconds, self.hits, self.misses)
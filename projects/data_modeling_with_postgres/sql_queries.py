@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+file_manifest_drop = "DROP TABLE IF EXISTS file_manifest"
 
 # CREATE TABLES
 
@@ -46,7 +47,8 @@ CREATE TABLE IF NOT EXISTS songs
         title VARCHAR, 
         artist_id VARCHAR REFERENCES artists(artist_id), 
         year INT, 
-        duration NUMERIC
+        duration NUMERIC,
+        ordinal BIGINT
     );
 
 """)
@@ -59,7 +61,8 @@ CREATE TABLE IF NOT EXISTS artists
         name VARCHAR, 
         location VARCHAR, 
         latitude NUMERIC, 
-        longitude NUMERIC
+        longitude NUMERIC,
+        ordinal BIGINT
     );
     
 """)
@@ -79,6 +82,171 @@ CREATE TABLE IF NOT EXISTS time
 
 """)
 
+# one row per input file already loaded, used to skip unchanged files
+file_manifest_create = ("""
+
+CREATE TABLE IF NOT EXISTS file_manifest
+    (
+        path VARCHAR PRIMARY KEY,
+        size BIGINT,
+        mtime DOUBLE PRECISION,
+        content_hash VARCHAR,
+        loaded_at TIMESTAMP DEFAULT now()
+    );
+
+""")
+
+# BULK LOAD SCHEMA
+
+# variants of the songs and songplays tables without foreign keys and, for
+# songplays, without a primary key. The dimension primary keys stay since
+# they are the arbiters of the ON CONFLICT upserts
+song_table_create_deferred = ("""
+
+CREATE TABLE IF NOT EXISTS songs
+    (
+        song_id VARCHAR PRIMARY KEY, 
+        title VARCHAR, 
+        artist_id VARCHAR, 
+        year INT, 
+        duration NUMERIC,
+        ordinal BIGINT
+    );
+
+""")
+
+songplay_table_create_deferred = (""" 
+
+CREATE TABLE IF NOT EXISTS songplays
+    (
+        songplay_id SERIAL, 
+        start_time TIMESTAMP, 
+        user_id INT, 
+        level VARCHAR, 
+        song_id VARCHAR, 
+        artist_id VARCHAR,
+        session_id INT,
+        location VARCHAR, 
+        user_agent VARCHAR
+    );
+    
+""")
+
+# PARTITIONED SONGPLAYS
+
+# songplays range partitioned by month of start_time. The partition key has
+# to be part of the primary key; the monthly partitions are created by
+# etl.py as events for a new month arrive
+songplay_table_create_partitioned = (""" 
+
+CREATE TABLE IF NOT EXISTS songplays
+    (
+        songplay_id SERIAL, 
+        start_time TIMESTAMP NOT NULL REFERENCES time(start_time), 
+        user_id INT REFERENCES users(user_id), 
+        level VARCHAR, 
+        song_id VARCHAR REFERENCES songs(song_id), 
+        artist_id VARCHAR REFERENCES artists(artist_id),
+        session_id INT,
+        location VARCHAR, 
+        user_agent VARCHAR,
+        PRIMARY KEY (songplay_id, start_time)
+    )
+    PARTITION BY RANGE (start_time);
+    
+""")
+
+songplay_table_create_partitioned_deferred = (""" 
+
+CREATE TABLE IF NOT EXISTS songplays
+    (
+        songplay_id SERIAL, 
+        start_time TIMESTAMP NOT NULL, 
+        user_id INT, 
+        level VARCHAR, 
+        song_id VARCHAR, 
+        artist_id VARCHAR,
+        session_id INT,
+        location VARCHAR, 
+        user_agent VARCHAR
+    )
+    PARTITION BY RANGE (start_time);
+    
+""")
+
+# {partition} is filled in with psycopg2.sql, the bounds are query parameters
+songplay_partition_create = ("""
+
+CREATE TABLE IF NOT EXISTS {partition} PARTITION OF songplays
+    FOR VALUES FROM (%s) TO (%s);
+
+""")
+
+songplay_partition_drop = "DROP TABLE IF EXISTS {partition}"
+
+songplay_partitioned_select = ("""
+
+    SELECT count(*)
+    FROM pg_partitioned_table
+    WHERE partrelid = 'songplays'::regclass
+
+""")
+
+songplay_partitions_select = ("""
+
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = 'songplays'::regclass
+    ORDER BY child.relname
+
+""")
+
+# CONSTRAINTS AND INDEXES
+
+song_foreign_keys_create = ("""
+
+ALTER TABLE songs
+    ADD CONSTRAINT songs_artist_id_fkey FOREIGN KEY (artist_id) REFERENCES artists(artist_id);
+
+""")
+
+songplay_primary_key_create = ("""
+
+ALTER TABLE songplays ADD PRIMARY KEY (songplay_id);
+
+""")
+
+songplay_partitioned_primary_key_create = ("""
+
+ALTER TABLE songplays ADD PRIMARY KEY (songplay_id, start_time);
+
+""")
+
+songplay_foreign_keys_create = ("""
+
+ALTER TABLE songplays
+    ADD CONSTRAINT songplays_start_time_fkey FOREIGN KEY (start_time) REFERENCES time(start_time),
+    ADD CONSTRAINT songplays_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(user_id),
+    ADD CONSTRAINT songplays_song_id_fkey FOREIGN KEY (song_id) REFERENCES songs(song_id),
+    ADD CONSTRAINT songplays_artist_id_fkey FOREIGN KEY (artist_id) REFERENCES artists(artist_id);
+
+""")
+
+# lookup indexes behind the song_select query
+song_lookup_index_create = "CREATE INDEX IF NOT EXISTS songs_title_duration_idx ON songs (title, duration)"
+artist_name_index_create = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name)"
+
+# the songplays primary key is only missing while the schema is in bulk load mode
+songplay_primary_key_select = ("""
+
+    SELECT count(*)
+    FROM pg_constraint
+    WHERE conrelid = 'songplays'::regclass
+    AND contype = 'p'
+
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -94,8 +262,7 @@ songplay_table_insert = ("""
             location, 
             user_agent
         )
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT (songplay_id) DO NOTHING;
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
 
 """)
 
@@ -163,6 +330,24 @@ time_table_insert = ("""
     
 """)
 
+file_manifest_upsert = ("""
+
+    INSERT INTO file_manifest 
+    (
+        path, 
+        size, 
+        mtime, 
+        content_hash
+    )
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (path) DO UPDATE
+    SET size = EXCLUDED.size,
+        mtime = EXCLUDED.mtime,
+        content_hash = EXCLUDED.content_hash,
+        loaded_at = now();
+
+""")
+
 # FIND SONGS
 
 song_select = ("""
@@ -177,7 +362,281 @@ song_select = ("""
     
 """)
 
+# every (title, artist name, duration) -> (song_id, artist_id) pair used to
+# build the in-memory song lookup index once per run
+song_lookup_select = ("""
+
+    SELECT
+        songs.title AS title,
+        artists.name AS artist_name,
+        songs.duration AS duration,
+        songs.song_id AS song_id,
+        artists.artist_id AS artist_id
+    FROM songs JOIN artists ON songs.artist_id = artists.artist_id
+
+""")
+
+file_manifest_select = ("""
+
+    SELECT path, size, mtime, content_hash
+    FROM file_manifest
+    WHERE path LIKE %s
+
+""")
+
+# BULK LOAD
+
+# session-scoped staging tables that COPY FROM STDIN streams each batch into
+# before a single set-based merge into the star schema
+time_staging_create = ("""
+
+CREATE TEMP TABLE IF NOT EXISTS time_staging
+    (
+        start_time TIMESTAMP,
+        hour INT, 
+        day INT, 
+        week INT, 
+        month INT, 
+        year INT, 
+        weekday INT
+    );
+
+""")
+
+user_staging_create = ("""
+
+CREATE TEMP TABLE IF NOT EXISTS user_staging
+    (
+        user_id INT,
+        first_name VARCHAR, 
+        last_name VARCHAR, 
+        gender CHAR(1), 
+        level VARCHAR,
+        ts BIGINT
+    );
+
+""")
+
+songplay_staging_create = ("""
+
+CREATE TEMP TABLE IF NOT EXISTS songplay_staging
+    (
+        start_time TIMESTAMP, 
+        user_id INT, 
+        level VARCHAR, 
+        song_id VARCHAR, 
+        artist_id VARCHAR,
+        song VARCHAR, 
+        artist VARCHAR,
+        length NUMERIC,
+        session_id INT,
+        location VARCHAR, 
+        user_agent VARCHAR
+    );
+
+""")
+
+artist_staging_create = ("""
+
+CREATE TEMP TABLE IF NOT EXISTS artist_staging
+    (
+        artist_id VARCHAR,
+        name VARCHAR, 
+        location VARCHAR, 
+        latitude NUMERIC, 
+        longitude NUMERIC,
+        ordinal BIGINT
+    );
+    
+""")
+
+song_staging_create = ("""
+
+CREATE TEMP TABLE IF NOT EXISTS song_staging
+    (
+        song_id VARCHAR, 
+        title VARCHAR, 
+        artist_id VARCHAR, 
+        year INT, 
+        duration NUMERIC,
+        ordinal BIGINT
+    );
+
+""")
+
+staging_truncate = "TRUNCATE time_staging, user_staging, songplay_staging"
+song_staging_truncate = "TRUNCATE artist_staging, song_staging"
+
+staging_copy = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+# a batch can hold an artist or song more than once; like the row inserts,
+# keep its first record in file order, given by the ordinal column
+artist_table_merge = ("""
+
+    INSERT INTO artists 
+    (
+        artist_id, 
+        name, 
+        location, 
+        latitude, 
+        longitude
+    )
+    SELECT DISTINCT ON (artist_id)
+        artist_id, 
+        name, 
+        location, 
+        latitude, 
+        longitude
+    FROM artist_staging
+    ORDER BY artist_id, ordinal
+    ON CONFLICT (artist_id) DO NOTHING;
+
+""")
+
+song_table_merge = ("""
+
+    INSERT INTO songs 
+    (
+        song_id,
+        title, 
+        artist_id, 
+        year, 
+        duration
+    )
+    SELECT DISTINCT ON (song_id)
+        song_id,
+        title, 
+        artist_id, 
+        year, 
+        duration
+    FROM song_staging
+    ORDER BY song_id, ordinal
+    ON CONFLICT (song_id) DO NOTHING;
+
+""")
+
+time_table_merge = ("""
+
+    INSERT INTO time 
+    (
+        start_time, 
+        hour, 
+        day, 
+        week, 
+        month, 
+        year, 
+        weekday
+    )
+    SELECT DISTINCT ON (start_time) *
+    FROM time_staging
+    ON CONFLICT(start_time) DO NOTHING;
+
+""")
+
+# an upsert may only touch each user once per statement, so keep the
+# most recent event per user within the batch
+user_table_merge = ("""
+
+    INSERT INTO users 
+    (
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level
+    )
+    SELECT DISTINCT ON (user_id)
+        user_id, 
+        first_name, 
+        last_name, 
+        gender, 
+        level
+    FROM user_staging
+    ORDER BY user_id, ts DESC
+    ON CONFLICT (user_id) DO UPDATE
+    SET level = EXCLUDED.level;
+
+""")
+
+songplay_table_merge = ("""
+
+    INSERT INTO songplays 
+        (
+            start_time, 
+            user_id, 
+            level, 
+            song_id, 
+            artist_id, 
+            session_id, 
+            location, 
+            user_agent
+        )
+    SELECT
+        sp.start_time,
+        sp.user_id,
+        sp.level,
+        matches.song_id,
+        matches.artist_id,
+        sp.session_id,
+        sp.location,
+        sp.user_agent
+    FROM songplay_staging sp
+    LEFT JOIN 
+    (
+        SELECT DISTINCT ON (songs.title, artists.name, songs.duration)
+            songs.song_id,
+            artists.artist_id,
+            songs.title,
+            artists.name,
+            songs.duration
+        FROM songs JOIN artists ON songs.artist_id = artists.artist_id
+        WHERE songs.title IN (SELECT song FROM songplay_staging)
+    ) matches
+    ON sp.song = matches.title
+    AND sp.artist = matches.name
+    AND sp.length = matches.duration;
+
+""")
+
+# used when song_id/artist_id were already resolved by the song lookup index
+songplay_table_resolved_merge = ("""
+
+    INSERT INTO songplays 
+        (
+            start_time, 
+            user_id, 
+            level, 
+            song_id, 
+            artist_id, 
+            session_id, 
+            location, 
+            user_agent
+        )
+    SELECT
+        start_time,
+        user_id,
+        level,
+        song_id,
+        artist_id,
+        session_id,
+        location,
+        user_agent
+    FROM songplay_staging;
+
+""")
+
 # QUERY LISTS
 
-create_table_queries = [time_table_create, user_table_create, artist_table_create, song_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_index_queries = [song_lookup_index_create, artist_name_index_create]
+create_table_queries = [time_table_create, user_table_create, artist_table_create, song_table_create, songplay_table_create, file_manifest_create] + create_index_queries
+deferred_create_table_queries = [time_table_create, user_table_create, artist_table_create, song_table_create_deferred, songplay_table_create_deferred, file_manifest_create]
+deferred_constraint_queries = [song_foreign_keys_create, songplay_primary_key_create, songplay_foreign_keys_create] + create_index_queries
+
+# replacements that turn either table list into one with a partitioned songplays
+partitioned_table_queries = {
+    songplay_table_create: songplay_table_create_partitioned,
+    songplay_table_create_deferred: songplay_table_create_partitioned_deferred,
+    songplay_primary_key_create: songplay_partitioned_primary_key_create
+}
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, file_manifest_drop]
+staging_table_queries = [time_staging_create, user_staging_create, songplay_staging_create, artist_staging_create, song_staging_create]
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+MS_PER_SECOND = 1000
+SECONDS_PER_HOUR = 3600
+SECONDS_PER_DAY = 86400
+
+TIME_COLUMNS = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+
+
+def civil_from_days(days):
+    """
+    Converts days since 1970-01-01 into (year, month, day) arrays of the
+    proleptic Gregorian calendar, using only integer arithmetic
+    (http://howardhinnant.github.io/date_algorithms.html#civil_from_days)
+    """
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+    return year, month, day
+
+
+def days_before_year(year):
+    """returns the days since 1970-01-01 of January 1st of each year"""
+    y = year - 1
+    era = y // 400
+    yoe = y - era * 400
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + 306 - 719468
+
+
+def iso_weeks_in_year(year):
+    """returns 53 for ISO years with a week 53 and 52 otherwise"""
+    def p(y):
+        return (y + y // 4 - y // 100 + y // 400) % 7
+    return 52 + ((p(year) == 4) | (p(year - 1) == 3))
+
+
+def time_table_rows(ts):
+    """
+    Derives the time dimension rows for an array of epoch millisecond
+    timestamps with numpy integer arithmetic. Duplicate timestamps are
+    dropped and the rows are returned sorted by start_time. week is the
+    ISO week number and weekday counts from Monday = 0
+    """
+    ts = np.unique(np.asarray(ts, dtype=np.int64))
+    seconds = ts // MS_PER_SECOND
+    days = seconds // SECONDS_PER_DAY
+
+    year, month, day = civil_from_days(days)
+    hour = (seconds % SECONDS_PER_DAY) // SECONDS_PER_HOUR
+    # 1970-01-01 was a Thursday
+    weekday = (days + 3) % 7
+
+    # ISO week: the week holding the year's first Thursday is week 1
+    ordinal = days - days_before_year(year) + 1
+    week = (ordinal - (weekday + 1) + 10) // 7
+    week = np.where(week < 1, iso_weeks_in_year(year - 1),
+                    np.where(week > iso_weeks_in_year(year), 1, week))
+
+    return pd.DataFrame({
+        'start_time': pd.to_datetime(ts, unit='ms'),
+        'hour': hour,
+        'day': day,
+        'week': week,
+        'month': month,
+        'year': year,
+        'weekday': weekday
+    }, columns=TIME_COLUMNS)
+
+
+class SeenTimestamps:
+    """
+    Set of the start_time values already sent to the time table during a
+    run, so each timestamp reaches the database once. Call reset() after a
+    rollback, since rolled back timestamps have to be sent again
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.sent = 0
+        self.skipped = 0
+
+    def filter(self, time_df):
+        """
+        Returns the rows of time_df whose start_time was not seen before
+        and marks them as seen
+        """
+        ts = time_df['start_time'].values.astype('datetime64[ms]').astype(np.int64).tolist()
+        new = np.fromiter((t not in self.seen for t in ts), dtype=bool, count=len(ts))
+        self.seen.update(ts)
+        self.sent += int(new.sum())
+        self.skipped += len(ts) - int(new.sum())
+        return time_df[new]
+
+    def reset(self):
+        """forgets every timestamp, e.g. after a rolled back batch"""
+        self.seen.clear()
+
+    def summary(self):
+        """one line report of how many time rows the dedup kept away from the database"""
+        return 'time dimension: {} rows sent, {} duplicate timestamps skipped'.format(self.sent, self.skipped)
@@ -0,0 +1,53 @@
+import numpy as np
+
+USER_COLUMNS = ["userId", "firstName", "lastName", "gender", "level"]
+
+
+def latest_user_rows(df):
+    """
+    Collapses the events of a log DataFrame to one users record per userId,
+    taken from the user's latest event by ts. Since the users upsert only
+    updates level, every earlier event of the same user is redundant
+    """
+    latest = df.sort_values('ts', kind='stable').drop_duplicates('userId', keep='last')
+    return latest[USER_COLUMNS]
+
+
+class SentUserStates:
+    """
+    Last users record sent to the database for each user during a run, so
+    a user whose state did not change since an earlier file is not
+    upserted again. Call reset() after a rollback, since rolled back
+    records have to be sent again
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.events = 0
+        self.sent = 0
+
+    def filter(self, user_df, events):
+        """
+        Returns the rows of user_df that differ from the state last sent
+        for their user and records them as sent. events is the number of
+        log events user_df was collapsed from
+        """
+        changed = np.zeros(len(user_df), dtype=bool)
+        for i, row in enumerate(user_df.itertuples(index=False)):
+            user_id, state = str(row[0]), tuple(row[1:])
+            if self.states.get(user_id) != state:
+                self.states[user_id] = state
+                changed[i] = True
+
+        self.events += events
+        self.sent += int(changed.sum())
+        return user_df[changed]
+
+    def reset(self):
+        """forgets every sent state, e.g. after a rolled back batch"""
+        self.states.clear()
+
+    def summary(self):
+        """one line report of how many user upserts the pre-aggregation saved"""
+        ratio = self.events / self.sent if self.sent else float('nan')
+        return 'users: {} events collapsed to {} upserts ({:.1f}x reduction)'.format(self.events, self.sent, ratio)
@@ -1,26 +1,48 @@
+import os
+import sys
+import argparse
 import psycopg2
+import sql_queries
 from sql_queries import copy_table_queries, insert_table_queries
 from cluster_helpers import load_config
+# modules shared by the projects, such as instrumentation.py, live in projects/
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Instrumentation, instrumented_cursor
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(cur, conn, metrics=None):
     """loads the staging tables from S3"""
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+    metrics = metrics or Instrumentation('redshift')
+    with metrics.stage('load_staging_tables'):
+        for query in copy_table_queries:
+            cur.execute(query)
+            conn.commit()
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, metrics=None):
     """performs the inserts into the fact and dimension tables"""
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+    metrics = metrics or Instrumentation('redshift')
+    with metrics.stage('insert_tables'):
+        for query in insert_table_queries:
+            cur.execute(query)
+            conn.commit()
+
+
+def parse_args():
+    """parses the command line options of the ETL pipeline"""
+    parser = argparse.ArgumentParser(description='Loads the staging, fact and dimension tables on Redshift')
+    parser.add_argument('--metrics-log', default=None, metavar='PATH',
+                        help="append a JSON line per finished stage and statement to PATH, '-' for stdout")
+    parser.add_argument('--prometheus', default=None, metavar='PATH',
+                        help='write the stage and statement totals to PATH in the Prometheus text format')
+    return parser.parse_args()
 
 
 def main():
     """driver program that authenticates to the Redshift cluster
     and loads the staging data from S3 into the staging tables and 
     lastly uses these to insert into the fact and dimension tables"""
+    args = parse_args()
     config = load_config()
     
     host = config["HOST"]
@@ -30,13 +52,23 @@ def main():
     db_port = config["DB_PORT"]
 
     conn = psycopg2.connect(f"host={host} dbname={db_name} user={db_user} password={db_password} port={db_port}")
-    cur = conn.cursor()
+    # time every COPY and INSERT, named after sql_queries.py
+    metrics = Instrumentation('redshift', args.metrics_log, log_statements=True)
+    metrics.name_statements(sql_queries)
+    cur = instrumented_cursor(conn, metrics)
     
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    load_staging_tables(cur, conn, metrics)
+    insert_tables(cur, conn, metrics)
 
     conn.close()
 
+    print('slowest statements:')
+    for line in metrics.summary():
+        print(line)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus)
+    metrics.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,298 @@
+import os
+import json
+import argparse
+from datetime import date, datetime, timedelta, timezone
+import numpy as np
+
+# Generates synthetic Sparkify song_data and log_data trees with the same
+# file layout and JSON shapes as the Udacity datasets, for scale testing
+# the Postgres and Spark pipelines. Every output is a function of the seed
+
+ID_ALPHABET = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+SYLLABLES = ['ba', 'ro', 'ki', 'lu', 'me', 'sa', 'to', 'ne', 'vi', 'da', 'lo', 'ra', 'shi', 'mon', 'tal',
+             'ven', 'cor', 'ash', 'el', 'ri', 'quin', 'dor', 'fa', 'zu', 'pe', 'gan', 'hol', 'ly', 'nor', 'wy']
+FIRST_NAMES = ['Walter', 'Kaylee', 'Lily', 'Aiden', 'Jayden', 'Jacob', 'Jacqueline', 'Sylvie', 'Ryan', 'Celeste',
+               'Anabelle', 'Connar', 'Stefany', 'Marina', 'Makinley', 'Kevin', 'Kynnedi', 'Chloe', 'Aleena', 'Adler']
+LAST_NAMES = ['Frye', 'Summers', 'Koch', 'Hess', 'Graves', 'Klein', 'Lynch', 'Cruz', 'Smith', 'Williams',
+              'Simpson', 'Moreno', 'White', 'Sutton', 'Jones', 'Arellano', 'Sanchez', 'Cuevas', 'Kirby', 'Barrera']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'Chicago-Naperville-Elgin, IL-IN-WI',
+             'La Crosse-Onalaska, WI-MN', 'Marinette, WI-MI', 'Tampa-St. Petersburg-Clearwater, FL',
+             'Atlanta-Sandy Springs-Roswell, GA', 'New Haven-Milford, CT', 'Red Bluff, CA',
+             'San Jose-Sunnyvale-Santa Clara, CA', 'Lansing-East Lansing, MI', 'Detroit-Warren-Dearborn, MI']
+ARTIST_LOCATIONS = ['', 'California - LA', 'Memphis, TN', 'London, England', 'New York, NY', 'Hamburg, Germany',
+                    'Detroit, MI', 'Kingston, Jamaica']
+USER_AGENTS = [
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36"',
+    '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2062.94 Safari/537.36"',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:30.0) Gecko/20100101 Firefox/30.0',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0'
+]
+# (page, method, status, share of the non-NextSong events), after the bundled logs
+OTHER_PAGES = [('Home', 'GET', 200, 0.65), ('Login', 'PUT', 307, 0.075), ('Logout', 'PUT', 307, 0.073),
+               ('Downgrade', 'GET', 200, 0.048), ('Settings', 'GET', 200, 0.045), ('Help', 'GET', 200, 0.038),
+               ('About', 'GET', 200, 0.029), ('Upgrade', 'GET', 200, 0.017), ('Save Settings', 'PUT', 307, 0.008),
+               ('Error', 'GET', 404, 0.007), ('Submit Upgrade', 'PUT', 307, 0.006),
+               ('Submit Downgrade', 'PUT', 307, 0.004)]
+MS_PER_DAY = 86400000
+
+
+def random_ids(rng, prefix, count, length=16):
+    """returns count distinct ids such as SOMZWCG12A8C13C480 made of prefix and length random characters"""
+    ids = []
+    seen = set()
+    while len(ids) < count:
+        for chars in ID_ALPHABET[rng.integers(0, len(ID_ALPHABET), size=(count - len(ids), length))]:
+            candidate = prefix + ''.join(chars)
+            if candidate not in seen:
+                seen.add(candidate)
+                ids.append(candidate)
+    return ids
+
+
+def random_names(rng, count, min_words=1, max_words=4):
+    """returns count title-cased names made of random syllables"""
+    names = []
+    for num_words in rng.integers(min_words, max_words + 1, size=count):
+        words = [''.join(SYLLABLES[i] for i in rng.integers(0, len(SYLLABLES), size=rng.integers(1, 4)))
+                 for _ in range(num_words)]
+        names.append(' '.join(words).title())
+    return names
+
+
+def zipf_weights(count, skew):
+    """returns popularity weights proportional to 1 / rank ** skew; skew 0 is uniform"""
+    weights = 1.0 / np.arange(1, count + 1) ** skew
+    return weights / weights.sum()
+
+
+def dumps_song(record):
+    """serializes a song record the way the song_data files are written"""
+    return json.dumps(record)
+
+
+def dumps_event(record):
+    """serializes a log event the way the log_data files are written, with escaped slashes"""
+    return json.dumps(record, separators=(',', ':')).replace('/', '\\/')
+
+
+def generate_songs(rng, num_songs, num_artists):
+    """
+    Returns the song records of the catalog, a list of dicts with the
+    fields of a song_data file, along with their track ids
+    """
+    artist_ids = random_ids(rng, 'AR', num_artists)
+    artist_names = random_names(rng, num_artists, 1, 3)
+    artist_locations = rng.integers(0, len(ARTIST_LOCATIONS), size=num_artists)
+    has_coordinates = rng.random(num_artists) < 0.4
+    latitudes = np.round(rng.uniform(-60, 70, size=num_artists), 5)
+    longitudes = np.round(rng.uniform(-150, 150, size=num_artists), 5)
+
+    song_ids = random_ids(rng, 'SO', num_songs)
+    track_ids = random_ids(rng, 'TR', num_songs)
+    titles = random_names(rng, num_songs)
+    song_artists = rng.integers(0, num_artists, size=num_songs)
+    durations = np.round(rng.uniform(60, 600, size=num_songs), 5)
+    years = np.where(rng.random(num_songs) < 0.4, 0, rng.integers(1950, 2011, size=num_songs))
+
+    songs = []
+    for i in range(num_songs):
+        a = song_artists[i]
+        songs.append({
+            "num_songs": 1,
+            "artist_id": artist_ids[a],
+            "artist_latitude": float(latitudes[a]) if has_coordinates[a] else None,
+            "artist_longitude": float(longitudes[a]) if has_coordinates[a] else None,
+            "artist_location": ARTIST_LOCATIONS[artist_locations[a]],
+            "artist_name": artist_names[a],
+            "song_id": song_ids[i],
+            "title": titles[i],
+            "duration": float(durations[i]),
+            "year": int(years[i])
+        })
+    return songs, track_ids
+
+
+def write_songs(output, songs, track_ids):
+    """writes one song_data/X/Y/Z/TR....json file per song, partitioned by the 3rd-5th track id characters"""
+    for song, track_id in zip(songs, track_ids):
+        directory = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            f.write(dumps_song(song))
+
+
+def generate_users(rng, num_users, start):
+    """returns the users of the simulated app as a list of dicts"""
+    users = []
+    start_ms = int(datetime(start.year, start.month, start.day, tzinfo=timezone.utc).timestamp() * 1000)
+    for i in range(num_users):
+        users.append({
+            "userId": str(i + 1),
+            "firstName": FIRST_NAMES[rng.integers(0, len(FIRST_NAMES))],
+            "lastName": LAST_NAMES[rng.integers(0, len(LAST_NAMES))],
+            "gender": 'F' if rng.random() < 0.5 else 'M',
+            "location": LOCATIONS[rng.integers(0, len(LOCATIONS))],
+            "userAgent": USER_AGENTS[rng.integers(0, len(USER_AGENTS))],
+            "registration": float(start_ms - int(rng.integers(0, 30 * MS_PER_DAY))),
+            "paid": bool(rng.random() < 0.25),
+            # day index from which a free user is on the paid level
+            "upgrade_day": int(rng.integers(0, 60)) if rng.random() < 0.2 else None
+        })
+    return users
+
+
+def generate_day(rng, day_index, day, songs, users, options):
+    """
+    Returns the serialized events of one day, sorted by ts. Includes
+    NextSong events drawn from the skewed song and user popularity, other
+    page views, logged out visitors, songs missing from the catalog and
+    exact duplicate lines at the configured rates
+    """
+    num_plays = options['events_per_day']
+    num_other = int(round(num_plays * options['other_page_ratio']))
+    num_events = num_plays + num_other
+
+    day_ms = int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() * 1000)
+    ts = day_ms + np.sort(rng.integers(0, MS_PER_DAY, size=num_events))
+    is_play = np.zeros(num_events, dtype=bool)
+    is_play[rng.permutation(num_events)[:num_plays]] = True
+
+    user_idx = rng.choice(len(users), size=num_events, p=options['user_weights'])
+    logged_out = ~is_play & (rng.random(num_events) < options['logged_out_rate'])
+    song_idx = rng.choice(len(songs), size=num_events, p=options['song_weights'])
+    unmatched = rng.random(num_events) < options['unmatched_rate']
+    other_page = rng.choice(len(OTHER_PAGES), size=num_events, p=options['page_weights'])
+
+    # one session per user per day; logged out visitors get their own sessions
+    session_ids = day_index * (len(users) + 1) * 2 + user_idx + 1
+    session_ids = np.where(logged_out, session_ids + len(users) + 1, session_ids)
+    order = np.lexsort((ts, session_ids))
+    new_session = np.ones(num_events, dtype=bool)
+    new_session[1:] = session_ids[order][1:] != session_ids[order][:-1]
+    starts = np.maximum.accumulate(np.where(new_session, np.arange(num_events), 0))
+    item_in_session = np.empty(num_events, dtype=np.int64)
+    item_in_session[order] = np.arange(num_events) - starts
+
+    lines = []
+    for i in range(num_events):
+        if logged_out[i]:
+            page, method, status, _ = OTHER_PAGES[other_page[i]]
+            event = {"artist": None, "auth": "Logged Out", "firstName": None, "gender": None,
+                     "itemInSession": int(item_in_session[i]), "lastName": None, "length": None,
+                     "level": "free", "location": None, "method": method, "page": page,
+                     "registration": None, "sessionId": int(session_ids[i]), "song": None, "status": status,
+                     "ts": int(ts[i]), "userAgent": None, "userId": ""}
+        else:
+            user = users[user_idx[i]]
+            paid = user['paid'] or (user['upgrade_day'] is not None and day_index >= user['upgrade_day'])
+            if is_play[i]:
+                page, method, status = 'NextSong', 'PUT', 200
+                if unmatched[i]:
+                    artist, song, length = options['unmatched_names'][song_idx[i] % len(options['unmatched_names'])]
+                else:
+                    record = songs[song_idx[i]]
+                    artist, song, length = record['artist_name'], record['title'], record['duration']
+            else:
+                page, method, status, _ = OTHER_PAGES[other_page[i]]
+                artist, song, length = None, None, None
+            event = {"artist": artist, "auth": "Logged In", "firstName": user['firstName'],
+                     "gender": user['gender'], "itemInSession": int(item_in_session[i]),
+                     "lastName": user['lastName'], "length": length, "level": 'paid' if paid else 'free',
+                     "location": user['location'], "method": method, "page": page,
+                     "registration": user['registration'], "sessionId": int(session_ids[i]), "song": song,
+                     "status": status, "ts": int(ts[i]), "userAgent": user['userAgent'],
+                     "userId": user['userId']}
+        line = dumps_event(event)
+        lines.append(line)
+        if rng.random() < options['duplicate_rate']:
+            lines.append(line)
+    return lines
+
+
+def log_path(output, day, layout):
+    """returns log_data/YYYY/MM/YYYY-MM-DD-events.json, or log_data/YYYY-MM-DD-events.json for the flat layout"""
+    name = '{}-events.json'.format(day.isoformat())
+    if layout == 'flat':
+        return os.path.join(output, 'log_data', name)
+    return os.path.join(output, 'log_data', '{:04d}'.format(day.year), '{:02d}'.format(day.month), name)
+
+
+def generate(output, num_songs=10000, num_artists=None, num_users=1000, num_events=100000,
+             start=date(2018, 11, 1), days=30, song_skew=1.1, user_skew=0.8, duplicate_rate=0.0,
+             unmatched_rate=0.05, other_page_ratio=0.18, logged_out_rate=0.2, layout='nested', seed=42):
+    """
+    Writes a synthetic song_data tree and days daily log files with about
+    num_events NextSong events in total under output. song_skew and
+    user_skew are the Zipf exponents of song and user popularity,
+    duplicate_rate the share of log lines written twice and unmatched_rate
+    the share of plays of songs missing from song_data. Returns a summary
+    dict of what was written
+    """
+    rng = np.random.default_rng(seed)
+    num_artists = num_artists or max(1, num_songs // 2)
+
+    songs, track_ids = generate_songs(rng, num_songs, num_artists)
+    write_songs(output, songs, track_ids)
+    users = generate_users(rng, num_users, start)
+
+    unmatched_titles = random_names(rng, 1000)
+    unmatched_artists = random_names(rng, 1000, 1, 3)
+    options = {
+        'events_per_day': max(1, num_events // days),
+        'other_page_ratio': other_page_ratio,
+        'logged_out_rate': logged_out_rate,
+        'duplicate_rate': duplicate_rate,
+        'unmatched_rate': unmatched_rate,
+        'song_weights': zipf_weights(num_songs, song_skew)[rng.permutation(num_songs)],
+        'user_weights': zipf_weights(num_users, user_skew)[rng.permutation(num_users)],
+        'page_weights': np.array([share for _, _, _, share in OTHER_PAGES]) / sum(share for _, _, _, share in OTHER_PAGES),
+        'unmatched_names': [(artist, title, float(length)) for artist, title, length
+                            in zip(unmatched_artists, unmatched_titles, np.round(rng.uniform(60, 600, 1000), 5))]
+    }
+
+    num_lines = 0
+    for day_index in range(days):
+        day = start + timedelta(days=day_index)
+        lines = generate_day(rng, day_index, day, songs, users, options)
+        path = log_path(output, day, layout)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        num_lines += len(lines)
+
+    return {'songs': num_songs, 'artists': num_artists, 'users': num_users, 'days': days,
+            'next_song_events': options['events_per_day'] * days, 'log_lines': num_lines}
+
+
+def main():
+    """driver program that writes a synthetic dataset to the output directory"""
+    parser = argparse.ArgumentParser(description='Generates synthetic Sparkify song_data and log_data')
+    parser.add_argument('output', help='directory that receives song_data/ and log_data/')
+    parser.add_argument('--num-songs', type=int, default=10000)
+    parser.add_argument('--num-artists', type=int, default=None, help='defaults to half the number of songs')
+    parser.add_argument('--num-users', type=int, default=1000)
+    parser.add_argument('--num-events', type=int, default=100000, help='total NextSong events')
+    parser.add_argument('--start-date', type=date.fromisoformat, default=date(2018, 11, 1))
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--song-skew', type=float, default=1.1, help='Zipf exponent of song popularity')
+    parser.add_argument('--user-skew', type=float, default=0.8, help='Zipf exponent of user activity')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='share of log lines written twice')
+    parser.add_argument('--unmatched-rate', type=float, default=0.05, help='share of plays of unknown songs')
+    parser.add_argument('--layout', choices=['nested', 'flat'], default='nested',
+                        help="'nested' writes log_data/YYYY/MM/ as read by the Postgres ETL, "
+                             "'flat' writes log_data/ as read by the Spark ETL")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    summary = generate(args.output, num_songs=args.num_songs, num_artists=args.num_artists,
+                       num_users=args.num_users, num_events=args.num_events, start=args.start_date,
+                       days=args.days, song_skew=args.song_skew, user_skew=args.user_skew,
+                       duplicate_rate=args.duplicate_rate, unmatched_rate=args.unmatched_rate,
+                       layout=args.layout, seed=args.seed)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
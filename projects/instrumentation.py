@@ -0,0 +1,194 @@
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+# Shared by the Postgres, Redshift and Spark pipelines. The Spark job only
+# records stages, so psycopg2 is optional and only needed by the cursor
+try:
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+METRIC_PREFIX = 'sparkify'
+
+
+class Instrumentation:
+    """
+    Collects the duration, rows, bytes read and retries of the stages and
+    SQL statements of a pipeline run. Finished stages are written as JSON
+    lines to log_path ('-' for stdout), along with every statement when
+    log_statements is set, and the per-name totals can be dumped in the
+    Prometheus text format at the end of the run
+    """
+
+    def __init__(self, pipeline, log_path=None, log_statements=False):
+        self.pipeline = pipeline
+        self.log = None
+        if log_path == '-':
+            self.log = sys.stdout
+        elif log_path:
+            self.log = open(log_path, 'a')
+        self.log_statements = log_statements
+        self.statement_names = {}
+        self.totals = {}
+        self.open_stages = []
+
+    def name_statements(self, module):
+        """names statements after the module-level SQL strings of module, e.g. sql_queries"""
+        for name, value in vars(module).items():
+            if isinstance(value, str) and not name.startswith('_'):
+                self.statement_names.setdefault(value, name)
+
+    def statement_name(self, query):
+        """returns the registered name of query, else its first 60 characters"""
+        if not isinstance(query, str):
+            query = str(query)
+        return self.statement_names.get(query) or ' '.join(query.split())[:60]
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """
+        Times the enclosed block as stage name. The yielded dict takes the
+        rows and bytes the stage handled; counts of nested stages are added
+        to it when they finish
+        """
+        counts = {'rows': 0, 'bytes': 0, 'retries': 0}
+        self.open_stages.append(counts)
+        start = time.perf_counter()
+        try:
+            yield counts
+        except Exception as e:
+            labels = dict(labels, error=type(e).__name__)
+            raise
+        finally:
+            self.open_stages.pop()
+            self.record(name, time.perf_counter() - start, **dict(counts, **labels))
+
+    def record(self, name, seconds, rows=0, bytes=0, retries=0, **labels):
+        """records a stage timed by the caller and adds its counts to the enclosing stage"""
+        if self.open_stages:
+            parent = self.open_stages[-1]
+            parent['rows'] += rows
+            parent['bytes'] += bytes
+            parent['retries'] += retries
+        self.add('stage', name, seconds, rows, bytes, retries, labels)
+
+    def count(self, rows=0, bytes=0, retries=0):
+        """adds rows, bytes or retries to the innermost open stage"""
+        if self.open_stages:
+            counts = self.open_stages[-1]
+            counts['rows'] += rows
+            counts['bytes'] += bytes
+            counts['retries'] += retries
+
+    def statement(self, query, seconds, rows, bytes=0, error=None):
+        """records one execution of query; rows is the cursor rowcount"""
+        labels = {'error': error} if error else {}
+        self.add('sql', self.statement_name(query), seconds, max(rows, 0), bytes, 0, labels,
+                 log=self.log_statements)
+
+    def add(self, kind, name, seconds, rows, bytes, retries, labels, log=True):
+        total = self.totals.setdefault((kind, name), {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0,
+                                                      'retries': 0, 'errors': 0})
+        total['count'] += 1
+        total['seconds'] += seconds
+        total['rows'] += rows
+        total['bytes'] += bytes
+        total['retries'] += retries
+        total['errors'] += 'error' in labels
+        if log and self.log is not None:
+            event = dict(labels, pipeline=self.pipeline, kind=kind, name=name, seconds=round(seconds, 6),
+                         rows=rows, bytes=bytes, retries=retries, time=time.time())
+            self.log.write(json.dumps(event, default=str) + '\n')
+
+    def summary(self, kind='sql', top=10):
+        """returns report lines for the top names of kind by total time"""
+        ranked = sorted(((total['seconds'], name, total) for (k, name), total in self.totals.items() if k == kind),
+                        key=lambda item: item[0], reverse=True)
+        return ['{:>10.3f}s {:>8} x {:>12} rows  {}'.format(seconds, total['count'], total['rows'], name)
+                for seconds, name, total in ranked[:top]]
+
+    def prometheus(self):
+        """returns the totals in the Prometheus text exposition format"""
+        lines = []
+        for kind, label in [('stage', 'stage'), ('sql', 'statement')]:
+            for field, suffix, help_text in [('count', 'executions', 'executions'),
+                                             ('seconds', 'seconds', 'total duration in seconds'),
+                                             ('rows', 'rows', 'rows affected'),
+                                             ('bytes', 'bytes_read', 'bytes read'),
+                                             ('retries', 'retries', 'retries'),
+                                             ('errors', 'errors', 'failed executions')]:
+                metric = '{}_{}_{}_total'.format(METRIC_PREFIX, kind, suffix)
+                lines.append('# HELP {} {} per {}'.format(metric, help_text, label))
+                lines.append('# TYPE {} counter'.format(metric))
+                for (k, name), total in sorted(self.totals.items()):
+                    if k == kind:
+                        lines.append('{}{{pipeline="{}",{}="{}"}} {}'.format(
+                            metric, escape_label(self.pipeline), label, escape_label(name), total[field]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """writes the totals to path, e.g. for the node_exporter textfile collector"""
+        with open(path, 'w') as f:
+            f.write(self.prometheus())
+
+    def close(self):
+        """writes the per statement totals to the log and closes it"""
+        if self.log is None:
+            return
+        for (kind, name), total in sorted(self.totals.items()):
+            if kind == 'sql':
+                event = dict(total, pipeline=self.pipeline, kind='sql_total', name=name,
+                             seconds=round(total['seconds'], 6), time=time.time())
+                self.log.write(json.dumps(event) + '\n')
+        if self.log is not sys.stdout:
+            self.log.close()
+        self.log = None
+
+
+def escape_label(value):
+    """escapes a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+if psycopg2 is not None:
+    class InstrumentedCursor(psycopg2.extensions.cursor):
+        """
+        Cursor that reports the duration and rowcount of every execute and
+        copy_expert to its instrumentation, and the bytes read by each COPY.
+        Create it with instrumented_cursor()
+        """
+        instrumentation = None
+
+        def execute(self, query, vars=None):
+            if self.instrumentation is None:
+                return super().execute(query, vars)
+            start = time.perf_counter()
+            try:
+                result = super().execute(query, vars)
+            except Exception as e:
+                self.instrumentation.statement(query, time.perf_counter() - start, 0, error=type(e).__name__)
+                raise
+            self.instrumentation.statement(query, time.perf_counter() - start, self.rowcount)
+            return result
+
+        def copy_expert(self, sql, file, size=8192):
+            if self.instrumentation is None:
+                return super().copy_expert(sql, file, size)
+            start = time.perf_counter()
+            position = file.tell() if hasattr(file, 'tell') else 0
+            try:
+                result = super().copy_expert(sql, file, size)
+            except Exception as e:
+                self.instrumentation.statement(sql, time.perf_counter() - start, 0, error=type(e).__name__)
+                raise
+            read = file.tell() - position if hasattr(file, 'tell') else 0
+            self.instrumentation.statement(sql, time.perf_counter() - start, self.rowcount, bytes=read)
+            return result
+
+    def instrumented_cursor(conn, instrumentation):
+        """opens a cursor on conn that reports its statements to instrumentation"""
+        cur = conn.cursor(cursor_factory=InstrumentedCursor)
+        cur.instrumentation = instrumentation
+        return cur
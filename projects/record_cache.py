@@ -0,0 +1,213 @@
+import os
+import json
+import glob
+import hashlib
+import argparse
+
+# Local cache of the parsed and typed song and log records as parquet files.
+# An entry holds the records of one source file and is named after its path,
+# size and modification time, so a changed file misses the cache and is
+# parsed again, and any grouping of the files into batches or Spark reads
+# finds the same entries. Song data is only cached as compacted shards, as an
+# entry per one-record song file is slower to read than the JSON it replaces.
+# pyarrow is only imported when the cache is used.
+# RECORD_FIELDS is the one definition of the song and log record types, from
+# which the Postgres and Spark ETLs and compact_song_data.py take their schemas
+
+# bump when the parsing or the types change, so existing entries are not read
+CACHE_VERSION = 2
+
+# arrow types of the fields of the source records, in file order
+RECORD_FIELDS = {
+    'song': [('num_songs', 'int64'), ('artist_id', 'string'), ('artist_latitude', 'float64'),
+             ('artist_longitude', 'float64'), ('artist_location', 'string'), ('artist_name', 'string'),
+             ('song_id', 'string'), ('title', 'string'), ('duration', 'float64'), ('year', 'int64')],
+    'log': [('artist', 'string'), ('auth', 'string'), ('firstName', 'string'), ('gender', 'string'),
+            ('itemInSession', 'int64'), ('lastName', 'string'), ('length', 'float64'), ('level', 'string'),
+            ('location', 'string'), ('method', 'string'), ('page', 'string'), ('registration', 'float64'),
+            ('sessionId', 'int64'), ('song', 'string'), ('status', 'int64'), ('ts', 'int64'),
+            ('userAgent', 'string'), ('userId', 'string')]
+}
+CONVERTERS = {'string': str, 'int64': int, 'float64': float}
+
+
+def source_key(filepath):
+    """returns the cache key of a source file: its absolute path, size and modification time"""
+    stat = os.stat(filepath)
+    return '{}|{}|{}'.format(os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+
+
+def arrow_schema(kind):
+    """returns the pyarrow schema of the records of kind, 'song' or 'log'"""
+    import pyarrow as pa
+    return pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in RECORD_FIELDS[kind]])
+
+
+def coerce_record(record, fields):
+    """returns the values of a parsed JSON record converted to the types of fields, '' and null as None"""
+    values = []
+    for name, type_name in fields:
+        value = record.get(name)
+        values.append(None if value is None or (value == '' and type_name != 'string')
+                      else CONVERTERS[type_name](value))
+    return values
+
+
+def parse_file(kind, filepath):
+    """
+    Parses a song or log file into a pyarrow Table of the record types of
+    kind. JSON lines are parsed by the pyarrow reader, falling back to
+    json.loads with conversions for values that do not have their JSON
+    type, e.g. numeric user ids. Parquet song shards are cast to the types
+    """
+    import pyarrow as pa
+    import pyarrow.json as pajson
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(kind)
+    if filepath.endswith('.parquet'):
+        return pq.read_table(filepath, columns=schema.names).cast(schema)
+    try:
+        options = pajson.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+        return pajson.read_json(filepath, parse_options=options)
+    except pa.ArrowInvalid:
+        with open(filepath) as f:
+            rows = [coerce_record(json.loads(line), RECORD_FIELDS[kind]) for line in f if line.strip()]
+        return pa.Table.from_pylist([dict(zip(schema.names, row)) for row in rows], schema=schema)
+
+
+class RecordCache:
+    """
+    Parquet cache of the parsed records of source files under directory,
+    with one subdirectory per record kind and cache version. Entries read
+    are marked as recently used, and evict() removes the least recently
+    used ones until the cache fits in max_bytes. Hits and misses are
+    counted per process, so pool workers keep their own counts
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def kind_dir(self, kind):
+        """returns the directory of the entries of kind"""
+        return os.path.join(self.directory, '{}-v{}'.format(kind, CACHE_VERSION))
+
+    def entry_path(self, kind, filepath):
+        """returns the path of the entry holding the records of a source file, named after its source key"""
+        name = hashlib.md5(source_key(filepath).encode()).hexdigest()
+        return os.path.join(self.kind_dir(kind), name + '.parquet')
+
+    def table(self, kind, filepaths):
+        """
+        Returns a pyarrow Table of the records of filepaths, concatenated from
+        the entry of each file, which is read from the cache or parsed and
+        written to it
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        tables = []
+        for filepath in filepaths:
+            path = self.entry_path(kind, filepath)
+            if os.path.exists(path):
+                os.utime(path)
+                self.hits += 1
+                tables.append(pq.read_table(path))
+                continue
+            self.misses += 1
+            table = parse_file(kind, filepath)
+            self.write(path, table)
+            tables.append(table)
+        return pa.concat_tables(tables) if tables else arrow_schema(kind).empty_table()
+
+    def records(self, kind, filepaths):
+        """returns the records of filepaths as a pandas DataFrame, see table()"""
+        return self.table(kind, filepaths).to_pandas()
+
+    def write(self, path, table):
+        """
+        Writes an entry through a temporary file, so a reader never sees a
+        partial entry. Names starting with '.' are skipped by Spark and Hadoop
+        listings
+        """
+        import pyarrow.parquet as pq
+
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        temporary = os.path.join(directory, '.{}.{}.tmp'.format(name, os.getpid()))
+        pq.write_table(table, temporary)
+        os.replace(temporary, path)
+
+    def lookup(self, kind, filepaths):
+        """
+        Returns the entries of the cached files of filepaths and the files
+        that are not cached, and marks those entries as recently used
+        """
+        entries, missing = [], []
+        for filepath in filepaths:
+            path = self.entry_path(kind, filepath)
+            if os.path.exists(path):
+                os.utime(path)
+                entries.append(path)
+            else:
+                missing.append(filepath)
+        self.hits += len(entries)
+        self.misses += len(missing)
+        return entries, missing
+
+    def size(self):
+        """returns the total size of the entries in bytes"""
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(self.directory, '*', '*.parquet')))
+
+    def evict(self):
+        """removes the least recently used entries until the cache fits in max_bytes; returns its size"""
+        entries = sorted(glob.glob(os.path.join(self.directory, '*', '*.parquet')), key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+            self.evicted += 1
+        return total
+
+    def summary(self):
+        """returns a one line report of the cache"""
+        return 'record cache: {} hits, {} misses, {} entries evicted, {:.1f} of {:.1f} MB used'.format(
+            self.hits, self.misses, self.evicted, self.size() / 1048576.0, self.max_bytes / 1048576.0)
+
+
+def source_files(directory):
+    """returns the song or log files under directory in sorted order, skipping names starting with '_' or '.'"""
+    return sorted(path for extension in ['json', 'ndjson', 'parquet']
+                  for path in glob.glob(os.path.join(directory, '**', '*.' + extension), recursive=True)
+                  if not os.path.basename(path).startswith(('_', '.')))
+
+
+def main():
+    """driver program that parses song and log files into the cache ahead of a run"""
+    parser = argparse.ArgumentParser(description='Fills the parsed record cache from song and log files')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--songs', default=None, help='song_data shards written by compact_song_data.py')
+    parser.add_argument('--logs', default=None, help='log_data directory')
+    parser.add_argument('--max-mb', type=int, default=1024)
+    args = parser.parse_args()
+
+    cache = RecordCache(args.cache_dir, args.max_mb * 1024 * 1024)
+    if args.songs:
+        shards = [path for path in source_files(args.songs) if path.endswith(('.ndjson', '.parquet'))]
+        if not shards:
+            print('no compacted shards under {}, one-record song files are not cached'.format(args.songs))
+        cache.table('song', shards)
+    if args.logs:
+        cache.table('log', source_files(args.logs))
+    cache.evict()
+    print(cache.summary())
+
+
+if __name__ == "__main__":
+    main()